@@ -1,16 +1,33 @@
 # imports
 import os, sys, re, shutil
-import json
+import hashlib
+import tempfile
+import zipfile
 from pathlib import Path
 from datetime import *
-import urllib.request
+import http.client
+import threading
+from time import sleep
+from base64 import b64encode
+from urllib.parse import urlsplit, urljoin, unquote
+from urllib.request import getproxies, proxy_bypass
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from functools import lru_cache
 from argparse import ArgumentParser, RawTextHelpFormatter, ArgumentTypeError
+import numpy as np
 import pandas as pd
 import plotly.express as px
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 from plotly.offline import init_notebook_mode
 
+# orjson parses the large exchangeInfo payloads several times faster, use it when it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # ----------------------------------------------------------------------------------------------------------------------
 # --------------------------------------- binance_data_download\enums.py -----------------------------------------------
 # ----------------------------------------------------------------------------------------------------------------------
@@ -21,6 +38,16 @@ DAILY_INTERVALS = ["1m", "5m", "15m", "30m", "1h", "2h", "4h", "6h", "8h", "12h"
 TRADING_TYPE = ["spot", "um", "cm"]
 MONTHS = list(range(1,13))
 MAX_DAYS = 35
+MAX_WORKERS = 16
+BLOCKSIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRY_AFTER = 60
+FAILED_LOG = '.failed.log'
+CONNECTION_TIMEOUT = 30
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
 BASE_URL = 'https://data.binance.vision/'
 START_DATE = date(int(YEARS[0]), MONTHS[0], 1)
 END_DATE = datetime.date(datetime.now())
@@ -30,12 +57,16 @@ END_DATE = datetime.date(datetime.now())
 # ----------------------------------------------------------------------------------------------------------------------
 
 
+# Resolved once at import, realpath costs a syscall per path component
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
 def get_destination_dir(file_url, folder=None):
     store_directory = os.environ.get('STORE_DIRECTORY')
     if folder:
         store_directory = folder
     if not store_directory:
-        store_directory = os.path.dirname(os.path.realpath(__file__))
+        store_directory = SCRIPT_DIR
     return os.path.join(store_directory, file_url)
 
 
@@ -43,57 +74,337 @@ def get_download_url(file_url):
     return "{}{}".format(BASE_URL, file_url)
 
 
+@lru_cache(maxsize=None)
+def get_proxy(scheme, host):
+    # Honour HTTP(S)_PROXY and NO_PROXY as urlopen did, returning the proxy address and its auth header if any
+    proxy = getproxies().get(scheme)
+    if not proxy or proxy_bypass(host):
+        return None, {}
+    parts = urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+    proxy_headers = {}
+    if parts.username:
+        credentials = '{}:{}'.format(unquote(parts.username), unquote(parts.password or ''))
+        proxy_headers['Proxy-Authorization'] = 'Basic ' + b64encode(credentials.encode()).decode()
+    return parts.hostname + (':{}'.format(parts.port) if parts.port else ''), proxy_headers
+
+
+# One keep-alive connection per (thread, host) so each download skips the TCP/TLS handshake
+connections = threading.local()
+
+
+def get_connection(scheme, host):
+    pool = connections.__dict__.setdefault('pool', {})
+    if (scheme, host) not in pool:
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        proxy, proxy_headers = get_proxy(scheme, host)
+        # the timeout stops a stalled socket from holding a worker forever, download_file retries it instead
+        if proxy is None:
+            connection = connection_class(host, timeout=CONNECTION_TIMEOUT)
+        else:
+            connection = connection_class(proxy, timeout=CONNECTION_TIMEOUT)
+            if scheme == 'https':
+                # tunnel through the proxy with CONNECT, so TLS is still end to end
+                connection.set_tunnel(host, headers=proxy_headers)
+        pool[(scheme, host)] = connection
+    return pool[(scheme, host)]
+
+
+def send_request(method, url, headers):
+    parts = urlsplit(url)
+    proxy, proxy_headers = get_proxy(parts.scheme, parts.netloc)
+    if proxy is not None and parts.scheme == 'http':
+        # a plain HTTP proxy is sent the absolute URL
+        target = url
+        headers = {**headers, **proxy_headers}
+    else:
+        target = parts.path + ('?' + parts.query if parts.query else '')
+    connection = get_connection(parts.scheme, parts.netloc)
+    try:
+        connection.request(method, target, headers=headers)
+        return connection.getresponse()
+    except (http.client.HTTPException, ConnectionError):
+        # the server closed the idle connection, reconnect once
+        connection.close()
+        connection.request(method, target, headers=headers)
+        return connection.getresponse()
+
+
+def http_request(method, url, headers={}):
+    # Follows redirects as urlopen did
+    for _ in range(MAX_REDIRECTS):
+        response = send_request(method, url, headers)
+        location = response.getheader('location')
+        if response.status not in REDIRECT_STATUSES or not location:
+            return response
+        # drain the body so the connection can be reused
+        response.read()
+        url = urljoin(url, location)
+    return send_request(method, url, headers)
+
+
+def http_get(url, headers={}):
+    return http_request('GET', url, headers)
+
+
 def get_all_symbols(type):
     if type == 'um':
-        response = urllib.request.urlopen("https://fapi.binance.com/fapi/v1/exchangeInfo").read()
+        url = "https://fapi.binance.com/fapi/v1/exchangeInfo"
     elif type == 'cm':
-        response = urllib.request.urlopen("https://dapi.binance.com/dapi/v1/exchangeInfo").read()
+        url = "https://dapi.binance.com/dapi/v1/exchangeInfo"
     else:
-        response = urllib.request.urlopen("https://api.binance.com/api/v3/exchangeInfo").read()
-    return list(map(lambda symbol: symbol['symbol'], json.loads(response)['symbols']))
+        url = "https://api.binance.com/api/v3/exchangeInfo"
+    response = http_get(url)
+    body = response.read()
+    if response.status != 200:
+        # e.g. a 403 or 451 when the API is blocked in this region, raised as urlopen did
+        raise HTTPError(url, response.status, response.reason, response.headers, None)
+    return [symbol['symbol'] for symbol in json_loads(body)['symbols']]
+
+
+class DownloadReader:
+    # Wraps a response so shutil.copyfileobj hashes the body and drives the progress bar as it reads
+    def __init__(self, response, length, progress=True):
+        self.response = response
+        self.length = length
+        self.progress = progress
+        self.received = 0
+        self.done = -1
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        buf = self.response.read(size)
+        self.received += len(buf)
+        self.sha256.update(buf)
+        if self.progress and self.length:
+            done = int(50 * self.received / self.length)
+            # only redraw when the bar moves, not on every block
+            if done != self.done:
+                self.done = done
+                sys.stdout.write("\r[%s%s]" % ('#' * done, '.' * (50 - done)))
+                sys.stdout.flush()
+        return buf
 
 
-def download_file(base_path, file_name, date_range=None, folder=None):
-    download_path = "{}{}".format(base_path, file_name)
+# Every file in a directory shares its base path, so the joins are only done once per directory
+@lru_cache(maxsize=4096)
+def get_save_dir(base_path, folder=None):
     if folder:
         base_path = os.path.join(folder, base_path)
+    return get_destination_dir(base_path, folder)
+
+
+def get_save_path(base_path, file_name, folder=None):
+    return os.path.join(get_save_dir(base_path, folder), file_name)
+
+
+# Directories made by this process, so each is only created once rather than once per file
+created_dirs = set()
+
+
+def make_directory(directory):
+    if directory not in created_dirs:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        created_dirs.add(directory)
+
+
+def preallocate(out_file, length):
+    # Reserve the whole file up front so concurrent downloads do not fragment each other on disk
+    out_file.flush()
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(out_file.fileno(), 0, length)
+        else:
+            os.ftruncate(out_file.fileno(), length)
+    except OSError:
+        # not supported by this filesystem, the file just grows as it is written
+        pass
+
+
+def verify_checksum(download_url, save_path, digest):
+    # Binance publishes "<sha256>  <file name>" next to every zip
+    response = http_get(download_url + '.CHECKSUM')
+    body = response.read()
+    if response.status == 404:
+        print("\nChecksum not found: {}.CHECKSUM".format(download_url))
+        return True
+    if response.status in RETRY_STATUSES:
+        raise RetryableResponse(response.status, response.getheader('retry-after'))
+    if response.status != 200:
+        # only a missing CHECKSUM means none is published, anything else leaves the zip unverified
+        raise http.client.HTTPException("HTTP {} for {}.CHECKSUM".format(response.status, download_url))
+    with open(save_path + '.CHECKSUM', 'wb') as checksum_file:
+        checksum_file.write(body)
+    return body.split()[0].decode().lower() == digest
+
+
+class RetryableResponse(http.client.HTTPException):
+    # Raised for statuses worth retrying, carrying the Retry-After header when the server sent one
+    def __init__(self, status, retry_after=None):
+        super().__init__("HTTP {}".format(status))
+        # capped, so a server asking for hours does not stall a worker for that long
+        self.retry_after = min(int(retry_after), MAX_RETRY_AFTER) if retry_after and retry_after.isdigit() else None
+
+
+def transfer_file(download_url, save_path, progress=True):
+    # Streams the file into save_path + '.part', continuing from the end of an earlier partial download
+    partial_path = save_path + '.part'
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    dl_file = http_get(download_url, {'Range': 'bytes={}-'.format(offset)} if offset else {})
+    if dl_file.status == 416:
+        # the partial file does not fit the remote file, start again from scratch
+        dl_file.read()
+        os.remove(partial_path)
+        return transfer_file(download_url, save_path, progress)
+    if dl_file.status in RETRY_STATUSES:
+        # throttled or a transient server error, download_file retries after a backoff
+        dl_file.read()
+        raise RetryableResponse(dl_file.status, dl_file.getheader('retry-after'))
+    if dl_file.status not in (200, 206):
+        # drain the body so the connection can be reused
+        dl_file.read()
+        print("\nFile not found: {}".format(download_url))
+        return None
+    if dl_file.status == 200:
+        # the server ignored the range and is sending the whole file
+        offset = 0
+
+    length = dl_file.getheader('content-length')
+    length = offset + int(length) if length else None
+    reader = DownloadReader(dl_file, length, progress)
+    reader.received = offset
+
+    with open(partial_path, 'r+b' if offset else 'wb', buffering=BLOCKSIZE) as out_file:
+        print("\nFile Download: {}".format(save_path))
+        if offset:
+            # the checksum covers the whole file, so hash the bytes kept from the earlier attempt first
+            for block in iter(lambda: out_file.read(BLOCKSIZE), b''):
+                reader.sha256.update(block)
+        if length:
+            preallocate(out_file, length)
+        try:
+            shutil.copyfileobj(reader, out_file, BLOCKSIZE)
+        finally:
+            # drop any preallocated space that was not written, e.g. if the transfer was cut short
+            out_file.truncate(out_file.tell())
+    if length is not None and reader.received != length:
+        # read() returns b'' instead of raising when the connection drops mid-body, download_file resumes the .part
+        raise http.client.IncompleteRead(b'', length - reader.received)
+    return reader
+
+
+def remote_size_matches(download_url, save_path):
+    # A HEAD costs one round trip and no body, enough to catch a truncated or stale file
+    response = http_request('HEAD', download_url)
+    response.read()
+    length = response.getheader('content-length')
+    if response.status != 200 or length is None:
+        # nothing to compare against, keep the file that is there
+        return True
+    return int(length) == os.path.getsize(save_path)
+
+
+def download_file(base_path, file_name, date_range=None, folder=None, progress=True, checksum=False,
+                  verify_existing=False):
+    download_path = "{}{}".format(base_path, file_name)
     # if date_range:
     #   date_range = date_range.replace(" ","_")
     #   base_path = os.path.join(base_path, date_range)
-    save_path = get_destination_dir(os.path.join(base_path, file_name), folder)
+    save_path = get_save_path(base_path, file_name, folder)
 
     if os.path.exists(save_path):
-        print("\nfile already exists! {}".format(save_path))
-        return
+        if not verify_existing or remote_size_matches(get_download_url(download_path), save_path):
+            print("\nfile already exists! {}".format(save_path))
+            return
+        # the download below replaces the file once it is complete
+        print("\nfile size does not match the remote file, downloading again: {}".format(save_path))
 
     # make the directory
-    if not os.path.exists(base_path):
-        Path(get_destination_dir(base_path)).mkdir(parents=True, exist_ok=True)
-
+    make_directory(os.path.dirname(save_path))
+
+    download_url = get_download_url(download_path)
+    reader = None
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            if reader is None:
+                reader = transfer_file(download_url, save_path, progress)
+                if reader is None:
+                    return
+            # the zip was hashed as it streamed, so verifying only costs fetching the small CHECKSUM file. It is checked
+            # before the rename, so a zip whose check failed or could not be fetched is never left looking complete
+            if checksum and not verify_checksum(download_url, save_path, reader.sha256.hexdigest()):
+                print("\nChecksum mismatch, removing {}".format(save_path))
+                os.remove(save_path + '.part')
+                return
+            break
+        except (http.client.HTTPException, OSError) as error:
+            # whatever reached the .part file is kept, so the next attempt only fetches the rest
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            print("\nDownload interrupted ({}), retrying: {}".format(error, download_url))
+            retry_after = getattr(error, 'retry_after', None)
+            sleep(retry_after if retry_after is not None else BACKOFF_FACTOR * 2 ** attempt)
+
+    # only complete files get the real name, so an interrupted download is never mistaken for a finished one
+    os.replace(save_path + '.part', save_path)
+
+
+def list_directory(directory):
     try:
-        download_url = get_download_url(download_path)
-        dl_file = urllib.request.urlopen(download_url)
-        length = dl_file.getheader('content-length')
-        if length:
-            length = int(length)
-            blocksize = max(4096, length // 100)
-
-        with open(save_path, 'wb') as out_file:
-            dl_progress = 0
-            print("\nFile Download: {}".format(save_path))
-            while True:
-                buf = dl_file.read(blocksize)
-                if not buf:
-                    break
-                dl_progress += len(buf)
-                out_file.write(buf)
-                done = int(50 * dl_progress / length)
-                sys.stdout.write("\r[%s%s]" % ('#' * done, '.' * (50 - done)))
+        return {entry.name for entry in os.scandir(directory)}
+    except FileNotFoundError:
+        # forget the directory if it has been deleted since it was made, e.g. by delete_historical_data
+        created_dirs.discard(directory)
+        return set()
+
+
+def download_files(jobs, date_range=None, folder=None, checksum=False, max_workers=MAX_WORKERS,
+                   verify_existing=False):
+    # the same symbol, interval or date given twice would otherwise have two threads writing the same file
+    jobs = list(dict.fromkeys(jobs))
+    # List each destination directory once rather than stat-ing every file
+    existing = {}
+    pending = []
+    skipped = []
+    for base_path, file_name in jobs:
+        save_dir = os.path.dirname(get_save_path(base_path, file_name, folder))
+        if save_dir not in existing:
+            existing[save_dir] = list_directory(save_dir)
+        # existing files are only checked against the remote size (one HEAD each) when asked to
+        if file_name in existing[save_dir] and not verify_existing:
+            skipped.append("file already exists! {}".format(os.path.join(save_dir, file_name)))
+        else:
+            pending.append((base_path, file_name))
+    if skipped:
+        print("\n" + "\n".join(skipped))
+
+    # Progress bars from concurrent downloads would overwrite each other, so only draw them when running serially
+    progress = max_workers == 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_file, base_path, file_name, date_range, folder, progress, checksum,
+                                   verify_existing):
+                   base_path + file_name for base_path, file_name in pending}
+        # as_completed yields in this thread, so the counter needs no lock
+        failed = []
+        for completed, future in enumerate(as_completed(futures), start=1):
+            try:
+                future.result()
+            except (http.client.HTTPException, OSError) as error:
+                # one file running out of retries should not abort the rest of the grid
+                print("\nDownload failed ({}): {}".format(error, futures[future]))
+                failed.append(get_download_url(futures[future]))
+            if not progress:
+                sys.stdout.write("\r[{}/{}] files done".format(completed, len(futures)))
                 sys.stdout.flush()
 
-    except urllib.error.HTTPError:
-        print("\nFile not found: {}".format(download_url))
-        pass
+    # the log lists what is still missing after this run, re-running the same command fetches only these and
+    # removes the log once nothing is left
+    log_path = get_destination_dir(FAILED_LOG, folder)
+    if failed:
+        with open(log_path, 'w') as log:
+            log.writelines(url + '\n' for url in failed)
+        print("\n{} files failed to download, see {}".format(len(failed), log_path))
+    elif os.path.exists(log_path):
+        os.remove(log_path)
 
 
 def convert_to_date_object(d):
@@ -109,8 +420,12 @@ def get_start_end_date_objects(date_range):
     return start_date, end_date
 
 
-def match_date_regex(arg_value, pat=re.compile(r'\d{4}-\d{2}-\d{2}')):
-    if not pat.match(arg_value):
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+def match_date_regex(arg_value):
+    # fullmatch so trailing characters such as '2021-01-01junk' are rejected
+    if not DATE_PATTERN.fullmatch(arg_value):
         raise ArgumentTypeError
     return arg_value
 
@@ -130,15 +445,84 @@ def check_directory(arg_value):
     return arg_value
 
 
-def get_path(trading_type, market_data_type, time_period, symbol, interval=None):
+def check_workers(arg_value):
+    # a thread pool needs at least one worker
+    workers = int(arg_value)
+    if workers < 1:
+        raise ArgumentTypeError('must be at least 1')
+    return workers
+
+
+def path_builder(trading_type, market_data_type, time_period):
+    # Resolve the parts of the path shared by every file once, returning a function that fills in the rest
     trading_type_path = 'data/spot'
     if trading_type != 'spot':
         trading_type_path = f'data/futures/{trading_type}'
-    if interval is not None:
-        path = f'{trading_type_path}/{time_period}/{market_data_type}/{symbol.upper()}/{interval}/'
-    else:
-        path = f'{trading_type_path}/{time_period}/{market_data_type}/{symbol.upper()}/'
-    return path
+    prefix = f'{trading_type_path}/{time_period}/{market_data_type}'
+
+    def build_path(symbol, interval=None):
+        if interval is not None:
+            return f'{prefix}/{symbol.upper()}/{interval}/'
+        return f'{prefix}/{symbol.upper()}/'
+
+    return build_path
+
+
+def get_path(trading_type, market_data_type, time_period, symbol, interval=None):
+    return path_builder(trading_type, market_data_type, time_period)(symbol, interval)
+
+
+def get_date_range(start_date, end_date):
+    if start_date and end_date:
+        return start_date + " " + end_date
+    return None
+
+
+def get_date_bounds(start_date, end_date):
+    start_date = convert_to_date_object(start_date) if start_date else START_DATE
+    end_date = convert_to_date_object(end_date) if end_date else END_DATE
+    return start_date, end_date
+
+
+def plan_monthly_downloads(trading_type, market_data_type, symbols, num_symbols, years, months, start_date, end_date, intervals=(None,)):
+    # Only builds the (path, file_name) jobs so that several plans can be handed to a single download_files call
+    start_date, end_date = get_date_bounds(start_date, end_date)
+    periods = [(year, month) for year in years for month in months
+               if start_date <= date(int(year), int(month), 1) <= end_date]
+    build_path = path_builder(trading_type, market_data_type, "monthly")
+    jobs = []
+    status = ["Found {} symbols".format(num_symbols)]
+
+    for current, symbol in enumerate(symbols):
+        status.append("[{}/{}] - start download monthly {} {} ".format(current+1, num_symbols, symbol, market_data_type))
+        for interval in intervals:
+            path = build_path(symbol, interval)
+            # everything before the date is shared by the files of a symbol and interval
+            name_prefix = "{}-{}-".format(symbol.upper(), interval or market_data_type)
+            for year, month in periods:
+                jobs.append((path, "{}{}-{:02d}.zip".format(name_prefix, year, month)))
+
+    print("\n".join(status))
+    return jobs
+
+
+def plan_daily_downloads(trading_type, market_data_type, symbols, num_symbols, dates, start_date, end_date, intervals=(None,)):
+    start_date, end_date = get_date_bounds(start_date, end_date)
+    dates = [d for d in dates if start_date <= d <= end_date]
+    build_path = path_builder(trading_type, market_data_type, "daily")
+    jobs = []
+    status = ["Found {} symbols".format(num_symbols)]
+
+    for current, symbol in enumerate(symbols):
+        status.append("[{}/{}] - start download daily {} {} ".format(current+1, num_symbols, symbol, market_data_type))
+        for interval in intervals:
+            path = build_path(symbol, interval)
+            name_prefix = "{}-{}-".format(symbol.upper(), interval or market_data_type)
+            for d in dates:
+                jobs.append((path, "{}{}.zip".format(name_prefix, d.isoformat())))
+
+    print("\n".join(status))
+    return jobs
 
 
 def get_parser(parser_type):
@@ -169,7 +553,13 @@ def get_parser(parser_type):
         help='Directory to store the downloaded data')
     parser.add_argument(
         '-c', dest='checksum', default=0, type=int, choices=[0, 1],
-        help='1 to download checksum file, default 0')
+        help='1 to verify new downloads against their checksum file, existing files are not checked, default 0')
+    parser.add_argument(
+        '-w', dest='workers', default=MAX_WORKERS, type=check_workers,
+        help='Number of files to download concurrently, default {}'.format(MAX_WORKERS))
+    parser.add_argument(
+        '-v', dest='verify', default=0, type=int, choices=[0, 1],
+        help='1 to check existing files against the remote size and download them again if it differs, default 0')
     parser.add_argument(
         '-t', dest='type', default='spot', choices=TRADING_TYPE,
         help='Valid trading types: {}'.format(TRADING_TYPE))
@@ -186,241 +576,174 @@ def get_parser(parser_type):
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def download_monthly_klines(trading_type, symbols, num_symbols, intervals, years, months, start_date, end_date, folder, checksum):
-  current = 0
-  date_range = None
-
-  if start_date and end_date:
-    date_range = start_date + " " + end_date
-
-  if not start_date:
-    start_date = START_DATE
-  else:
-    start_date = convert_to_date_object(start_date)
-
-  if not end_date:
-    end_date = END_DATE
-  else:
-    end_date = convert_to_date_object(end_date)
-
-  print("Found {} symbols".format(num_symbols))
-
-  for symbol in symbols:
-    print("[{}/{}] - start download monthly {} klines ".format(current+1, num_symbols, symbol))
-    for interval in intervals:
-      for year in years:
-        for month in months:
-          current_date = convert_to_date_object('{}-{}-01'.format(year, month))
-          if current_date >= start_date and current_date <= end_date:
-            path = get_path(trading_type, "klines", "monthly", symbol, interval)
-            file_name = "{}-{}-{}-{}.zip".format(symbol.upper(), interval, year, '{:02d}'.format(month))
-            download_file(path, file_name, date_range, folder)
-
-            if checksum == 1:
-              checksum_path = get_path(trading_type, "klines", "monthly", symbol, interval)
-              checksum_file_name = "{}-{}-{}-{}.zip.CHECKSUM".format(symbol.upper(), interval, year, '{:02d}'.format(month))
-              download_file(checksum_path, checksum_file_name, date_range, folder)
-
-    current += 1
-
-
-def download_daily_klines(trading_type, symbols, num_symbols, intervals, dates, start_date, end_date, folder, checksum):
-  current = 0
-  date_range = None
-
-  if start_date and end_date:
-    date_range = start_date + " " + end_date
-
-  if not start_date:
-    start_date = START_DATE
-  else:
-    start_date = convert_to_date_object(start_date)
-
-  if not end_date:
-    end_date = END_DATE
-  else:
-    end_date = convert_to_date_object(end_date)
+def download_monthly_klines(trading_type, symbols, num_symbols, intervals, years, months, start_date, end_date, folder, checksum, max_workers=MAX_WORKERS, verify_existing=0):
+  jobs = plan_monthly_downloads(trading_type, "klines", symbols, num_symbols, years, months, start_date, end_date, intervals)
+  download_files(jobs, get_date_range(start_date, end_date), folder, checksum == 1, max_workers, verify_existing == 1)
 
+def download_daily_klines(trading_type, symbols, num_symbols, intervals, dates, start_date, end_date, folder, checksum, max_workers=MAX_WORKERS, verify_existing=0):
   #Get valid intervals for daily
   intervals = list(set(intervals) & set(DAILY_INTERVALS))
-  print("Found {} symbols".format(num_symbols))
-
-  for symbol in symbols:
-    print("[{}/{}] - start download daily {} klines ".format(current+1, num_symbols, symbol))
-    for interval in intervals:
-      for date in dates:
-        current_date = convert_to_date_object(date)
-        if current_date >= start_date and current_date <= end_date:
-          path = get_path(trading_type, "klines", "daily", symbol, interval)
-          file_name = "{}-{}-{}.zip".format(symbol.upper(), interval, date)
-          download_file(path, file_name, date_range, folder)
-
-          if checksum == 1:
-            checksum_path = get_path(trading_type, "klines", "daily", symbol, interval)
-            checksum_file_name = "{}-{}-{}.zip.CHECKSUM".format(symbol.upper(), interval, date)
-            download_file(checksum_path, checksum_file_name, date_range, folder)
-
-    current += 1
+  jobs = plan_daily_downloads(trading_type, "klines", symbols, num_symbols, dates, start_date, end_date, intervals)
+  download_files(jobs, get_date_range(start_date, end_date), folder, checksum == 1, max_workers, verify_existing == 1)
 
 # ----------------------------------------------------------------------------------------------------------------------
 # ---------------------------------------- binance_data_download\download_trade.py -------------------------------------
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def download_monthly_trades(trading_type, symbols, num_symbols, years, months, start_date, end_date, folder, checksum):
-    current = 0
-    date_range = None
-
-    if start_date and end_date:
-        date_range = start_date + " " + end_date
-
-    if not start_date:
-        start_date = START_DATE
-    else:
-        start_date = convert_to_date_object(start_date)
-
-    if not end_date:
-        end_date = END_DATE
-    else:
-        end_date = convert_to_date_object(end_date)
-
-    print("Found {} symbols".format(num_symbols))
-
-    for symbol in symbols:
-        print("[{}/{}] - start download monthly {} trades ".format(current + 1, num_symbols, symbol))
-        for year in years:
-            for month in months:
-                current_date = convert_to_date_object('{}-{}-01'.format(year, month))
-                if current_date >= start_date and current_date <= end_date:
-                    path = get_path(trading_type, "trades", "monthly", symbol)
-                    file_name = "{}-trades-{}-{}.zip".format(symbol.upper(), year, '{:02d}'.format(month))
-                    download_file(path, file_name, date_range, folder)
-
-                    if checksum == 1:
-                        checksum_path = get_path(trading_type, "trades", "monthly", symbol)
-                        checksum_file_name = "{}-trades-{}-{}.zip.CHECKSUM".format(symbol.upper(), year,
-                                                                                   '{:02d}'.format(month))
-                        download_file(checksum_path, checksum_file_name, date_range, folder)
-
-        current += 1
-
+def download_monthly_trades(trading_type, symbols, num_symbols, years, months, start_date, end_date, folder, checksum, max_workers=MAX_WORKERS, verify_existing=0):
+    jobs = plan_monthly_downloads(trading_type, "trades", symbols, num_symbols, years, months, start_date, end_date)
+    download_files(jobs, get_date_range(start_date, end_date), folder, checksum == 1, max_workers, verify_existing == 1)
 
-def download_daily_trades(trading_type, symbols, num_symbols, dates, start_date, end_date, folder, checksum):
-    current = 0
-    date_range = None
+def download_daily_trades(trading_type, symbols, num_symbols, dates, start_date, end_date, folder, checksum, max_workers=MAX_WORKERS, verify_existing=0):
+    jobs = plan_daily_downloads(trading_type, "trades", symbols, num_symbols, dates, start_date, end_date)
+    download_files(jobs, get_date_range(start_date, end_date), folder, checksum == 1, max_workers, verify_existing == 1)
 
-    if start_date and end_date:
-        date_range = start_date + " " + end_date
-
-    if not start_date:
-        start_date = START_DATE
-    else:
-        start_date = convert_to_date_object(start_date)
-
-    if not end_date:
-        end_date = END_DATE
-    else:
-        end_date = convert_to_date_object(end_date)
+# ----------------------------------------------------------------------------------------------------------------------
+# ------------------------------------ binance_data_download\download_aggTrade.py --------------------------------------
+# ----------------------------------------------------------------------------------------------------------------------
 
-    print("Found {} symbols".format(num_symbols))
+def download_monthly_aggTrades(trading_type, symbols, num_symbols, years, months, start_date, end_date, folder, checksum, max_workers=MAX_WORKERS, verify_existing=0):
+    jobs = plan_monthly_downloads(trading_type, "aggTrades", symbols, num_symbols, years, months, start_date, end_date)
+    download_files(jobs, get_date_range(start_date, end_date), folder, checksum == 1, max_workers, verify_existing == 1)
 
-    for symbol in symbols:
-        print("[{}/{}] - start download daily {} trades ".format(current + 1, num_symbols, symbol))
-        for date in dates:
-            current_date = convert_to_date_object(date)
-            if current_date >= start_date and current_date <= end_date:
-                path = get_path(trading_type, "trades", "daily", symbol)
-                file_name = "{}-trades-{}.zip".format(symbol.upper(), date)
-                download_file(path, file_name, date_range, folder)
-
-                if checksum == 1:
-                    checksum_path = get_path(trading_type, "trades", "daily", symbol)
-                    checksum_file_name = "{}-trades-{}.zip.CHECKSUM".format(symbol.upper(), date)
-                    download_file(checksum_path, checksum_file_name, date_range, folder)
+def download_daily_aggTrades(trading_type, symbols, num_symbols, dates, start_date, end_date, folder, checksum, max_workers=MAX_WORKERS, verify_existing=0):
+    jobs = plan_daily_downloads(trading_type, "aggTrades", symbols, num_symbols, dates, start_date, end_date)
+    download_files(jobs, get_date_range(start_date, end_date), folder, checksum == 1, max_workers, verify_existing == 1)
 
 # ----------------------------------------------------------------------------------------------------------------------
-# ------------------------------------ binance_data_download\download_aggTrade.py --------------------------------------
+# ------------------------------------------------- historical_data.py -------------------------------------------------
 # ----------------------------------------------------------------------------------------------------------------------
 
-def download_monthly_aggTrades(trading_type, symbols, num_symbols, years, months, start_date, end_date, folder,
-                               checksum):
-    current = 0
-    date_range = None
+# Columns of the Binance kline CSVs
+KLINE_COLUMNS = ['open time', 'open', 'high', 'low', 'close', 'volume', 'close time', 'quote asset volume',
+                 'number of trades', 'taker buy asset volume', 'taker buy quote asset volume', 'ignore']
+KLINE_DTYPES = {'open time': 'int64', 'open': 'float64', 'high': 'float64', 'low': 'float64', 'close': 'float64',
+                'volume': 'float64', 'close time': 'int64', 'quote asset volume': 'float64',
+                'number of trades': 'int64', 'taker buy asset volume': 'float64',
+                'taker buy quote asset volume': 'float64'}
+
+# Columns of the Binance trade CSVs and the dtypes of those used when collating
+TRADE_COLUMNS = ["tradeID", "price", "qty", "quoteQty", "time", "isBuyerMaker", "isBestMatch"]
+TRADE_DTYPES = {"price": "float64", "qty": "float64", "quoteQty": "float64", "time": "int64"}
+
+# pyarrow's CSV parser is multithreaded, fall back to the pandas C parser when it is not installed
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = pa_csv = None
 
-    if start_date and end_date:
-        date_range = start_date + " " + end_date
+# ----------------------------------------------- Utility functions -----------------------------------------------
 
-    if not start_date:
-        start_date = START_DATE
-    else:
-        start_date = convert_to_date_object(start_date)
 
-    if not end_date:
-        end_date = END_DATE
-    else:
-        end_date = convert_to_date_object(end_date)
-
-    print("Found {} symbols".format(num_symbols))
+def parquet_cache_path(filepath):
+    """
+    Returns the path of the parquet copy of a downloaded zip file, kept under test_data/binance/.cache, or None for
+    files outside test_data/binance, which are not cached
 
-    for symbol in symbols:
-        print("[{}/{}] - start download monthly {} aggTrades ".format(current + 1, num_symbols, symbol))
-        for year in years:
-            for month in months:
-                current_date = convert_to_date_object('{}-{}-01'.format(year, month))
-                if current_date >= start_date and current_date <= end_date:
-                    path = get_path(trading_type, "aggTrades", "monthly", symbol)
-                    file_name = "{}-aggTrades-{}-{}.zip".format(symbol.upper(), year, '{:02d}'.format(month))
-                    download_file(path, file_name, date_range, folder)
+    :param filepath: The pathname of the zip file
+    """
+    head, sep, tail = filepath.partition("/test_data/binance/")
+    if not sep:
+        return None
+    return f"{head}{sep}.cache/{os.path.splitext(tail)[0]}.parquet"
 
-                    if checksum == 1:
-                        checksum_path = get_path(trading_type, "aggTrades", "monthly", symbol)
-                        checksum_file_name = "{}-aggTrades-{}-{}.zip.CHECKSUM".format(symbol.upper(), year,
-                                                                                      '{:02d}'.format(month))
-                        download_file(checksum_path, checksum_file_name, date_range, folder)
 
-        current += 1
+def read_parquet_cached(filepath, parse, columns=None):
+    """
+    Parses a downloaded zip file, reading the parquet copy written by an earlier call instead while the zip is
+    unchanged
 
+    :param filepath: The pathname of the zip file
+    :param parse: Function parsing the zip file into a DataFrame of every column that may be requested
+    :param columns: The columns to be returned, all columns if None
+    """
+    cache_path = parquet_cache_path(filepath)
+    if cache_path is None:
+        df = parse(filepath)
+        return df if columns is None else df[columns]
+
+    # The cache is stamped with the modification time of the zip it was parsed from, so a zip that has been
+    # downloaded again is parsed again (and a deleted zip raises rather than being served from the cache)
+    zip_mtime = os.stat(filepath).st_mtime_ns
+    if os.path.exists(cache_path) and os.stat(cache_path).st_mtime_ns == zip_mtime:
+        return pd.read_parquet(cache_path, columns=columns)
+
+    df = parse(filepath)
+    # The cache only saves parsing time, so failing to write it (e.g. a full or read-only disk) still returns df
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Writing to a uniquely named temporary file first so an interrupted write never leaves a truncated cache
+        # file behind, and two processes parsing the same zip do not write into each other's file
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+        os.close(fd)
+        try:
+            df.to_parquet(tmp_path, compression="zstd", index=False)
+            os.utime(tmp_path, ns=(zip_mtime, zip_mtime))
+            os.replace(tmp_path, cache_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    except OSError:
+        pass
+    return df if columns is None else df[columns]
 
-def download_daily_aggTrades(trading_type, symbols, num_symbols, dates, start_date, end_date, folder, checksum):
-    current = 0
-    date_range = None
 
-    if start_date and end_date:
-        date_range = start_date + " " + end_date
+def read_zipped_csv(filename, column_names, dtypes):
+    """
+    Reads the CSV in a Binance zip file with pyarrow's multithreaded parser, only parsing the columns in dtypes
 
-    if not start_date:
-        start_date = START_DATE
-    else:
-        start_date = convert_to_date_object(start_date)
+    :param filename: The pathname of the zip file
+    :param column_names: The names of every column of the CSV, which has no header
+    :param dtypes: Dictionary of the columns to be read and their dtypes
+    """
+    # Decompressing the single CSV in the archive into memory and handing it to pyarrow's parser
+    with zipfile.ZipFile(filename) as archive:
+        csv_bytes = archive.read(archive.namelist()[0])
+    table = pa_csv.read_csv(pa.BufferReader(csv_bytes),
+                            read_options=pa_csv.ReadOptions(column_names=column_names),
+                            convert_options=pa_csv.ConvertOptions(
+                                include_columns=list(dtypes),
+                                column_types={name: pa.type_for_alias(dtype) for name, dtype in dtypes.items()}))
+    # Freeing each Arrow column as it is converted so the table and the DataFrame are not both held in full
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def read_trade_file_pandas(filename, nrows=None):
+    """
+    Reads the collated columns of a zipped trade CSV with the pandas C parser
 
-    if not end_date:
-        end_date = END_DATE
-    else:
-        end_date = convert_to_date_object(end_date)
+    :param filename: The pathname of the zip file
+    :param nrows: The maximum number of rows imported, all rows if None
+    """
+    return pd.read_csv(filename, compression='zip', header=None, names=TRADE_COLUMNS, usecols=list(TRADE_DTYPES),
+                       dtype=TRADE_DTYPES, engine='c', nrows=nrows)
 
-    print("Found {} symbols".format(num_symbols))
 
-    for symbol in symbols:
-        print("[{}/{}] - start download daily {} aggTrades ".format(current + 1, num_symbols, symbol))
-        for date in dates:
-            current_date = convert_to_date_object(date)
-            if current_date >= start_date and current_date <= end_date:
-                path = get_path(trading_type, "aggTrades", "daily", symbol)
-                file_name = "{}-aggTrades-{}.zip".format(symbol.upper(), date)
-                download_file(path, file_name, date_range, folder)
+def read_trade_file(filename):
+    """
+    Reads the collated columns of a zipped trade CSV, using pyarrow when it is installed
 
-                if checksum == 1:
-                    checksum_path = get_path(trading_type, "aggTrades", "daily", symbol)
-                    checksum_file_name = "{}-aggTrades-{}.zip.CHECKSUM".format(symbol.upper(), date)
-                    download_file(checksum_path, checksum_file_name, date_range, folder)
+    :param filename: The pathname of the zip file
+    """
+    if pa_csv is None:
+        return read_trade_file_pandas(filename)
+    return read_parquet_cached(filename, lambda path: read_zipped_csv(path, TRADE_COLUMNS, TRADE_DTYPES))
 
-        current += 1
 
-# ----------------------------------------------------------------------------------------------------------------------
-# ------------------------------------------------- historical_data.py -------------------------------------------------
-# ----------------------------------------------------------------------------------------------------------------------
+def run_sums(values, starts):
+    """
+    Returns the sum of each contiguous run of values
 
-# ----------------------------------------------- Utility functions -----------------------------------------------
+    :param values: 1D numpy array
+    :param starts: Sorted indices at which each run starts, the first being 0
+    """
+    # reduceat needs at least one index, an empty file has no runs
+    if len(starts) == 0:
+        return values[:0]
+    return np.add.reduceat(values, starts)
 
 
 def trade_data_collation(filename, symbol, limit_rows=False, nrows=50000):
@@ -432,28 +755,115 @@ def trade_data_collation(filename, symbol, limit_rows=False, nrows=50000):
     :param filename: the pathname of the csv files
     :param symbol: associated symbol of trade data
     """
-    # Read CSV file
+    # Read CSV file, only parsing the columns used in the collation
     if limit_rows:
-        df = pd.read_csv(filename, compression='zip', header=None, sep=',', quotechar='"',
-                         names=["tradeID", "price", "qty", "quoteQty", "time", "isBuyerMaker", "isBestMatch"],
-                         nrows=nrows)
+        df = read_trade_file_pandas(filename, nrows=nrows)
     else:
-        df = pd.read_csv(filename, compression='zip', header=None, sep=',', quotechar='"',
-                             names=["tradeID", "price", "qty", "quoteQty", "time", "isBuyerMaker", "isBestMatch"])
-
-    # Floors time to 10 seconds and then converts back to milliseconds
-    df["time"] = df["time"].floordiv(10000) * 10000
-    # Grouping data and suming and averaging necessary columns
-    df = df.groupby("time", as_index=False).agg({'price': 'mean', 'qty': 'sum', 'quoteQty': 'sum'})
-    # Add symbol column
-    df["symbol"] = symbol
+        df = read_trade_file(filename)
+
+    # Floors time to 10 seconds and then converts back to milliseconds, working on a single int64 array
+    time_ms = df["time"].to_numpy(copy=True)
+    np.floor_divide(time_ms, 10000, out=time_ms)
+    np.multiply(time_ms, 10000, out=time_ms)
+    # Grouping data and suming and averaging necessary columns. Binance trade files are in time order, so each
+    # bucket is a contiguous run that can be reduced in one pass without sorting or hashing
+    if np.any(time_ms[1:] < time_ms[:-1]):
+        order = np.argsort(time_ms, kind="stable")
+        time_ms = time_ms[order]
+        df = df.iloc[order]
+    starts = np.flatnonzero(np.diff(time_ms, prepend=time_ms[:1] - 1))
+    counts = np.diff(np.append(starts, len(time_ms)))
+    df = pd.DataFrame({"time": time_ms[starts],
+                       "price": run_sums(df["price"].to_numpy(), starts) / counts,
+                       "qty": run_sums(df["qty"].to_numpy(), starts),
+                       "quoteQty": run_sums(df["quoteQty"].to_numpy(), starts)})
+    # Add symbol column, categorical so it is one code per row rather than one string
+    df["symbol"] = constant_categorical(symbol, len(df), pd.CategoricalDtype([symbol]))
     # Return DataFrame
     return df
 
 
+def read_kline_file(filepath, columns=None):
+    """
+    Reads a single zipped kline CSV
+
+    :param filepath: The pathname of the zip file
+    :param columns: The columns to be read, all but the unused 'ignore' column if None
+    """
+    usecols = list(KLINE_DTYPES) if columns is None else columns
+    # Only the columns in KLINE_DTYPES are parsed (and cached), so anything else is rejected the same way whether
+    # or not pyarrow is installed
+    unknown = [column for column in usecols if column not in KLINE_DTYPES]
+    if unknown:
+        raise ValueError("Kline columns not recognised or not read: {}".format(unknown))
+    if pa is None:
+        return pd.read_csv(filepath, compression='zip', names=KLINE_COLUMNS, usecols=usecols,
+                           dtype={column: KLINE_DTYPES[column] for column in usecols})
+
+    # Caching every used column so later reads can select any subset
+    return read_parquet_cached(filepath, lambda path: read_zipped_csv(path, KLINE_COLUMNS, KLINE_DTYPES), usecols)
+
+
+def parallel_map(executor_class, function, *iterables):
+    """
+    Maps the function over the iterables with a pool from executor_class, or serially in this process when there
+    is only one job or the RESEARCHTOOLS_PARALLEL environment variable is set to 0 (e.g. to debug or profile the
+    function)
+
+    :param executor_class: ThreadPoolExecutor or ProcessPoolExecutor
+    :param function: The function to be mapped
+    :param iterables: The arguments of the function, as for map
+    :return: Returns a list of the results in order
+    """
+    iterables = [list(iterable) for iterable in iterables]
+    jobs = min(map(len, iterables), default=0)
+    if jobs <= 1 or os.environ.get("RESEARCHTOOLS_PARALLEL", "1") == "0":
+        return list(map(function, *iterables))
+    # Never starting more workers than there are jobs, for a ProcessPoolExecutor each worker is a whole process
+    cpus = os.cpu_count() or 1
+    max_workers = cpus if executor_class is ProcessPoolExecutor else min(32, cpus + 4)
+    with executor_class(max_workers=min(jobs, max_workers)) as executor:
+        return list(executor.map(function, *iterables))
+
+
+def constant_categorical(value, length, dtype):
+    """
+    Returns a categorical column of the given length holding a single value
+
+    :param value: The value repeated down the column
+    :param length: The number of rows in the column
+    :param dtype: The CategoricalDtype of the column, must contain value
+    """
+    return pd.Categorical.from_codes(np.full(length, dtype.categories.get_loc(value)), dtype=dtype)
+
+
+def frames_in_order(frames, column):
+    """
+    Returns whether concatenating the frames in order gives a sorted column, assuming each frame is already sorted
+
+    :param frames: List of DataFrames, each sorted by column
+    :param column: The column to check
+    """
+    bounds = [(frame[column].iat[0], frame[column].iat[-1]) for frame in frames if len(frame) > 0]
+    return all(last <= first for (_, last), (first, _) in zip(bounds, bounds[1:]))
+
+
+@lru_cache(maxsize=128)
+def daily_date_strs(start_date, end_date):
+    """
+    Returns a tuple of the dates between the start and end date (inclusive) formatted as in the Binance file names
+
+    :params start_date: The start date in the format YYYY-MM-DD
+    :params end_date: The end date in the format YYYY-MM-DD
+    """
+    start_date = datetime.strptime(start_date, "%Y-%m-%d")
+    end_date = datetime.strptime(end_date, "%Y-%m-%d")
+    return tuple(date.strftime("%Y-%m-%d") for date in pd.date_range(start_date, end_date, freq='d'))
+
+
 def downloaded_filepaths(type_, start_date, end_date, symbol_data_required):
     """
-    Returns dictionary of downloaded data with key of filepath and value of (symbol, interval)
+    Returns a list of (filepath, symbol, interval) tuples of the downloaded data, in file order
 
     :params type_: Either klines or trades, depending on the needed data
     :params start_date: The start date of the requested data
@@ -461,65 +871,68 @@ def downloaded_filepaths(type_, start_date, end_date, symbol_data_required):
     :symbol_data_required: The symbols required for the backtest
     """
 
-    # Getting list of relevant dates
-    start_date = datetime.strptime(start_date, "%Y-%m-%d")
-    end_date = datetime.strptime(end_date, "%Y-%m-%d")
-    date_range = pd.date_range(start_date, end_date, freq='d')
-
-    # Iterating over required files and adding to dictionary
-    file_format = "{}/test_data/binance/data/spot/daily/{}/{}/{}-{}-{}.zip"
-    filepaths = dict()
-
-    for symbol in symbol_data_required.keys():
-        if len(symbol_data_required[symbol]) > 0:
-            for interval in symbol_data_required[symbol]:
-                for date in date_range:
-                    date_format = date.strftime("%Y-%m-%d")
-                    if type_ == "klines":
-                        filepath = file_format.format(os.getcwd(), type_, "{}/{}".format(symbol, interval), symbol,
-                                                      interval, date_format)
-                    elif type_ == "trades":
-                        filepath = file_format.format(os.getcwd(), type_, symbol, symbol, type_, date_format)
-                    else:
-                        raise ValueError("Tried to det filepaths of type that was not recognised: type={}".format(type_))
-                    filepaths[filepath] = (symbol, interval)
-        else:
-            for date in date_range:
-                date_format = date.strftime("%Y-%m-%d")
-                if type_ == "trades":
-                    filepath = file_format.format(os.getcwd(), type_, symbol, symbol, type_, date_format)
-                filepaths[filepath] = (symbol, None)
+    # Getting list of relevant dates, formatted once per date range
+    date_strs = daily_date_strs(start_date, end_date)
+
+    # Resolving the working directory once rather than once per file
+    base_path = f"{os.getcwd()}/test_data/binance/data/spot/daily/{type_}"
 
-    return filepaths
+    # Building the path prefix of each symbol (and interval) once, only the date changes between files
+    if type_ == "klines":
+        prefixes = [(f"{base_path}/{symbol}/{interval}/{symbol}-{interval}-", symbol, interval)
+                    for symbol, intervals in symbol_data_required.items()
+                    for interval in dict.fromkeys(intervals)]
+    elif type_ == "trades":
+        prefixes = [(f"{base_path}/{symbol}/{symbol}-trades-", symbol, None)
+                    for symbol in symbol_data_required.keys()]
+    else:
+        raise ValueError("Tried to det filepaths of type that was not recognised: type={}".format(type_))
+
+    # Building the list of required files
+    return [(f"{prefix}{date_str}.zip", symbol, interval)
+            for prefix, symbol, interval in prefixes
+            for date_str in date_strs]
 
 # ----------------------------------------------- Get Historical Data -----------------------------------------------
 
 
-def get_binance_kline_data(start_date, end_date, symbol_data_required):
+def get_binance_kline_data(start_date, end_date, symbol_data_required, columns=None):
     """
     Used to get binance market data
 
     :param start_date: The start date of the data wanting the be obtained
     :param end_date: The finish date of the data wanting the be obtained
     :param symbol_data_required: Dictionary containing symbols as keys and list of intervals as values
+    :param columns: The kline columns to be read, all but 'ignore' if None ('close time' is always read)
     :return: Returns a pandas DataFrame of the data
     """
-    # Headers for the CSV
-    headers = ['open time', 'open', 'high', 'low', 'close', 'volume', 'close time', 'quote asset volume',
-               'number of trades', 'taker buy asset volume', 'taker buy quote asset volume', 'ignore']
+    # Close time is needed to order the data
+    if columns is not None and 'close time' not in columns:
+        columns = [*columns, 'close time']
 
-    # Creating DataFrame
-    kline_data = pd.DataFrame()
+    # Collecting the per-file DataFrames so they are concatenated once
+    frames = []
 
-    # Iterating over downloaded files
+    # Sharing the categories across files keeps symbol and interval categorical through the concat
     filepaths = downloaded_filepaths("klines", start_date, end_date, symbol_data_required)
-    for filepath in filepaths.keys():
-        part_df = pd.read_csv(filepath, compression='zip', names=headers)
-        part_df["symbol"] = filepaths[filepath][0]
-        part_df["interval"] = filepaths[filepath][1]
-        kline_data = kline_data.append(part_df)
+    symbol_dtype = pd.CategoricalDtype(list(dict.fromkeys(symbol for _, symbol, _ in filepaths)))
+    interval_dtype = pd.CategoricalDtype(list(dict.fromkeys(interval for _, _, interval in filepaths)))
+
+    # Reading the downloaded files concurrently, zip decompression and the C parser release the GIL
+    parts = parallel_map(ThreadPoolExecutor, lambda filepath: read_kline_file(filepath, columns),
+                         [filepath for filepath, _, _ in filepaths])
 
-    kline_data = kline_data.sort_values(by="close time")
+    for part_df, (_, symbol, interval) in zip(parts, filepaths):
+        part_df["symbol"] = constant_categorical(symbol, len(part_df), symbol_dtype)
+        part_df["interval"] = constant_categorical(interval, len(part_df), interval_dtype)
+        frames.append(part_df)
+
+    kline_data = pd.concat(frames, ignore_index=True)
+
+    # Each file is already sorted and they are read in date order, so a sort is only needed when files overlap
+    # in time (several symbols or intervals), where mergesort can take advantage of the sorted runs
+    if not frames_in_order(frames, "close time"):
+        kline_data = kline_data.sort_values(by="close time", kind="mergesort")
     return kline_data
 
 
@@ -527,42 +940,51 @@ def get_binance_trade_data(start_date, end_date, symbols):
     """
     Used to get trade data and collate it into 10 second intervals
     - For now only uses established filenames
+    - Several files are collated in worker processes, so on platforms that spawn them (macOS, Windows) scripts
+      calling this need an if __name__ == "__main__" guard
 
     :param symbols: List of symbols wanting to be received
     :param end_date: The end date
     :param start_date: The start date
     :return: Returns a pandas DataFrame of the data
     """
-    # Initialize DataFrame
-    trade_data = pd.DataFrame()
-
     # Changing symbols list to dictionary
     symbols_dict = dict()
     for symbol in symbols:
         symbols_dict[symbol] = []
 
-    # Get filepaths dictionary
+    # Get filepaths
     filepaths = downloaded_filepaths("trades", start_date, end_date, symbols_dict)
 
-    # Iterate through filepaths
-    for filepath in filepaths.keys():
-        # Importing data with debug features
-        part_data = trade_data_collation(filepath, filepaths[filepath][0])
-        trade_data = trade_data.append(part_data, ignore_index=True)
+    # Collate the files in parallel, each file is parsed and grouped independently of the others
+    frames = parallel_map(ProcessPoolExecutor, trade_data_collation, [filepath for filepath, _, _ in filepaths],
+                          [symbol for _, symbol, _ in filepaths])
+
+    # Sharing the symbol categories across files keeps the column categorical through the concat
+    symbol_dtype = pd.CategoricalDtype(list(symbols_dict))
+    for frame in frames:
+        frame["symbol"] = frame["symbol"].cat.set_categories(symbol_dtype.categories)
 
     # Return trade data
-    return trade_data.sort_values(by="time")
+    trade_data = pd.concat(frames, ignore_index=True)
+
+    # Each collated file is already sorted by time, so a sort is only needed when files overlap in time (several
+    # symbols), where mergesort merges the sorted runs rather than sorting from scratch
+    if not frames_in_order(frames, "time"):
+        trade_data = trade_data.sort_values(by="time", kind="mergesort")
+    return trade_data
 
 # -------------------------------------------- Downloading Data Methods --------------------------------------------
 
 
-def download_binance_trade_data(symbols: list, start_date, end_date):
+def download_binance_trade_data(symbols: list, start_date, end_date, verify_existing=False):
     """
     Used to download trade data from Binance.
 
     :param start_date: The start date
     :param end_date: The end date
     :param symbols: list of symbols to be downloaded
+    :param verify_existing: If True existing files are downloaded again when their size differs from the remote file
     """
     print("\n----------------------------------- Downloading Historical Data -----------------------------------")
 
@@ -570,24 +992,25 @@ def download_binance_trade_data(symbols: list, start_date, end_date):
 
     # for symbol in symbol_data_required.keys():
     # Get all dates between two dates
-    dates = pd.date_range(start=start_date, end=end_date, freq='D').to_pydatetime().tolist()
-    dates = [date.strftime("%Y-%m-%d") for date in dates]
+    dates = list(pd.date_range(start=start_date, end=end_date, freq='D').date)
 
     # Download daily data
     download_daily_trades(trading_type='spot', symbols=symbols, num_symbols=len(symbols), dates=dates,
-                          start_date=start_date, end_date=end_date, folder=trades_base_path, checksum=0)
+                          start_date=start_date, end_date=end_date, folder=trades_base_path, checksum=0,
+                          verify_existing=verify_existing)
 
     print("\n----------------------------------- Finished Downloading Historical Data ---------"
           "--------------------------\n")
 
 
-def download_binance_kline_data(symbol_data_required: dict, start_date, end_date):
+def download_binance_kline_data(symbol_data_required: dict, start_date, end_date, verify_existing=False):
     """
     Used to download kline data from Binance.
 
     :param start_date: The start date
     :param end_date: The end date
     :param symbol_data_required: Dictionary with symbols as keys and a list of required intervals as values
+    :param verify_existing: If True existing files are downloaded again when their size differs from the remote file
     """
     print("\n----------------------------------- Downloading Historical Data -----------------------------------")
 
@@ -595,15 +1018,18 @@ def download_binance_kline_data(symbol_data_required: dict, start_date, end_date
 
     # for symbol in symbol_data_required.keys():
     # Get all dates between two dates
-    dates = pd.date_range(start=start_date, end=end_date, freq='D').to_pydatetime().tolist()
-    dates = [date.strftime("%Y-%m-%d") for date in dates]
+    dates = list(pd.date_range(start=start_date, end=end_date, freq='D').date)
 
-    # Iterate through intervals
+    # Planning the files of every symbol first so they are all downloaded by one pool, rather than one pool
+    # per symbol that has to finish before the next symbol starts
+    jobs = []
     for symbol, intervals in symbol_data_required.items():
-        # Download interval data
-        download_daily_klines(trading_type='spot', symbols=[symbol], num_symbols=1, intervals=intervals,
-                              dates=dates, start_date=start_date, end_date=end_date, folder=kline_base_path,
-                              checksum=0)
+        intervals = [interval for interval in intervals if interval in DAILY_INTERVALS]
+        jobs += plan_daily_downloads(trading_type='spot', market_data_type='klines', symbols=[symbol], num_symbols=1,
+                                     dates=dates, start_date=start_date, end_date=end_date, intervals=intervals)
+
+    # Download interval data
+    download_files(jobs, folder=kline_base_path, verify_existing=verify_existing)
 
     print("\n----------------------------------- Finished Downloading Historical Data ---------"
           "--------------------------\n")
@@ -644,17 +1070,16 @@ def get_trade_data_plot(symbols: list, start_date: str, end_date: str):
         # Make subplot figure
         fig = make_subplots(rows=len(symbols), cols=1, x_title='Time (UNIX)', y_title='Price')
 
-        # row counter
-        row_count = 1
+        # Get trade data for every symbol at once and split it, rather than reading the files once per symbol
+        trade_data = get_binance_trade_data(start_date=start_date, end_date=end_date, symbols=symbols)
+        trades_by_symbol = dict(tuple(trade_data.groupby("symbol", observed=True, sort=False)))
 
-        # Iterate through symbols
-        for symbol in symbols:
-            # Get trade data
-            trade_data = get_binance_trade_data(start_date=start_date, end_date=end_date, symbols=[symbol])
+        # Build a trace per symbol, WebGL traces stay responsive with many points
+        traces = [go.Scattergl(x=trades_by_symbol[symbol]['time'], y=trades_by_symbol[symbol]['price'],
+                               name="{}".format(symbol), mode='lines') for symbol in symbols]
 
-            # Add plot to figure and increment row count
-            fig.append_trace(go.Scatter(x=trade_data['time'], y=trade_data['price'], name="{}".format(symbol)), row=row_count, col=1)
-            row_count += 1
+        # Add plots to figure in one call, one row per symbol
+        fig.add_traces(traces, rows=list(range(1, len(traces) + 1)), cols=[1] * len(traces))
 
         # Update title and print output
         # fig.update_layout(title_text="Trade data")
@@ -662,7 +1087,7 @@ def get_trade_data_plot(symbols: list, start_date: str, end_date: str):
     else:
         # Create figure
         fig = px.line(get_binance_trade_data(start_date=start_date, end_date=end_date, symbols=[symbols[0]]), x='time',
-                      y='price')
+                      y='price', render_mode='webgl')
         return fig
 
 # ------------------------------------ Plotting Kline Data ------------------------------------
@@ -678,13 +1103,25 @@ def get_kline_data_plot(symbols_intervals: list, start_date: str, end_date: str)
     :return: Returns plot
     """
     fig = make_subplots(rows=len(symbols_intervals))
-    row_count = 1
+
+    # Get the klines for every (symbol, interval) in a single read and split them, rather than one read per plot
+    symbol_data_required = dict()
     for (symbol, interval) in symbols_intervals:
-        kline_data = get_binance_kline_data(start_date=start_date, end_date=end_date, symbol_data_required={symbol: [interval]})
-        fig_temp = go.Candlestick(x=kline_data['close time'], open=kline_data['open'], high=kline_data['high'],
-                                     low=kline_data['low'], close=kline_data['close'])
+        symbol_data_required.setdefault(symbol, []).append(interval)
+    kline_data = get_binance_kline_data(start_date=start_date, end_date=end_date, symbol_data_required=symbol_data_required,
+                                        columns=['open', 'high', 'low', 'close', 'close time'])
+    klines_by_pair = dict(tuple(kline_data.groupby(["symbol", "interval"], observed=True, sort=False)))
+
+    traces = []
+    for (symbol, interval) in symbols_intervals:
+        pair_klines = klines_by_pair[(symbol, interval)]
+        traces.append(go.Candlestick(x=pair_klines['close time'], open=pair_klines['open'], high=pair_klines['high'],
+                                     low=pair_klines['low'], close=pair_klines['close']))
         # fig_temp.update(fig.update_layout(xaxis_rangeslider_visible=False))
-        fig.add_trace(fig_temp, row=row_count, col=1)
-        row_count += 1
 
+    # Add plots to figure in one call, one row per (symbol, interval)
+    fig.add_traces(traces, rows=list(range(1, len(traces) + 1)), cols=[1] * len(traces))
+
+    # Candlesticks have no WebGL equivalent, keep the zoom and pan state when the figure is updated
+    fig.update_layout(uirevision='constant')
     return fig
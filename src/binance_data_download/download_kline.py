@@ -10,84 +10,19 @@
 import sys
 import pandas as pd
 from src.binance_data_download.enums import *
-from src.binance_data_download.utility import download_file, get_all_symbols, get_parser, convert_to_date_object, \
-  get_path
+from src.binance_data_download.utility import download_files, get_all_symbols, get_parser, convert_to_date_object, \
+  get_date_range, plan_monthly_downloads, plan_daily_downloads
 
 
-def download_monthly_klines(trading_type, symbols, num_symbols, intervals, years, months, start_date, end_date, folder, checksum):
-  current = 0
-  date_range = None
-
-  if start_date and end_date:
-    date_range = start_date + " " + end_date
-
-  if not start_date:
-    start_date = START_DATE
-  else:
-    start_date = convert_to_date_object(start_date)
-
-  if not end_date:
-    end_date = END_DATE
-  else:
-    end_date = convert_to_date_object(end_date)
-
-  print("Found {} symbols".format(num_symbols))
-
-  for symbol in symbols:
-    print("[{}/{}] - start download monthly {} klines ".format(current+1, num_symbols, symbol))
-    for interval in intervals:
-      for year in years:
-        for month in months:
-          current_date = convert_to_date_object('{}-{}-01'.format(year, month))
-          if current_date >= start_date and current_date <= end_date:
-            path = get_path(trading_type, "klines", "monthly", symbol, interval)
-            file_name = "{}-{}-{}-{}.zip".format(symbol.upper(), interval, year, '{:02d}'.format(month))
-            download_file(path, file_name, date_range, folder)
-
-            if checksum == 1:
-              checksum_path = get_path(trading_type, "klines", "monthly", symbol, interval)
-              checksum_file_name = "{}-{}-{}-{}.zip.CHECKSUM".format(symbol.upper(), interval, year, '{:02d}'.format(month))
-              download_file(checksum_path, checksum_file_name, date_range, folder)
-
-    current += 1
-
-def download_daily_klines(trading_type, symbols, num_symbols, intervals, dates, start_date, end_date, folder, checksum):
-  current = 0
-  date_range = None
-
-  if start_date and end_date:
-    date_range = start_date + " " + end_date
-
-  if not start_date:
-    start_date = START_DATE
-  else:
-    start_date = convert_to_date_object(start_date)
-
-  if not end_date:
-    end_date = END_DATE
-  else:
-    end_date = convert_to_date_object(end_date)
+def download_monthly_klines(trading_type, symbols, num_symbols, intervals, years, months, start_date, end_date, folder, checksum, max_workers=MAX_WORKERS, verify_existing=0):
+  jobs = plan_monthly_downloads(trading_type, "klines", symbols, num_symbols, years, months, start_date, end_date, intervals)
+  download_files(jobs, get_date_range(start_date, end_date), folder, checksum == 1, max_workers, verify_existing == 1)
 
+def download_daily_klines(trading_type, symbols, num_symbols, intervals, dates, start_date, end_date, folder, checksum, max_workers=MAX_WORKERS, verify_existing=0):
   #Get valid intervals for daily
   intervals = list(set(intervals) & set(DAILY_INTERVALS))
-  print("Found {} symbols".format(num_symbols))
-
-  for symbol in symbols:
-    print("[{}/{}] - start download daily {} klines ".format(current+1, num_symbols, symbol))
-    for interval in intervals:
-      for date in dates:
-        current_date = convert_to_date_object(date)
-        if current_date >= start_date and current_date <= end_date:
-          path = get_path(trading_type, "klines", "daily", symbol, interval)
-          file_name = "{}-{}-{}.zip".format(symbol.upper(), interval, date)
-          download_file(path, file_name, date_range, folder)
-
-          if checksum == 1:
-            checksum_path = get_path(trading_type, "klines", "daily", symbol, interval)
-            checksum_file_name = "{}-{}-{}.zip.CHECKSUM".format(symbol.upper(), interval, date)
-            download_file(checksum_path, checksum_file_name, date_range, folder)
-
-    current += 1
+  jobs = plan_daily_downloads(trading_type, "klines", symbols, num_symbols, dates, start_date, end_date, intervals)
+  download_files(jobs, get_date_range(start_date, end_date), folder, checksum == 1, max_workers, verify_existing == 1)
 
 if __name__ == "__main__":
     parser = get_parser('klines')
@@ -102,10 +37,9 @@ if __name__ == "__main__":
       num_symbols = len(symbols)
 
     if args.dates:
-      dates = args.dates
+      dates = [convert_to_date_object(date) for date in args.dates]
     else:
-      dates = pd.date_range(end = datetime.today(), periods = MAX_DAYS).to_pydatetime().tolist()
-      dates = [date.strftime("%Y-%m-%d") for date in dates]
-      download_monthly_klines(args.type, symbols, num_symbols, args.intervals, args.years, args.months, args.startDate, args.endDate, args.folder, args.checksum)
-    download_daily_klines(args.type, symbols, num_symbols, args.intervals, dates, args.startDate, args.endDate, args.folder, args.checksum)
+      dates = list(pd.date_range(end = datetime.today(), periods = MAX_DAYS).date)
+      download_monthly_klines(args.type, symbols, num_symbols, args.intervals, args.years, args.months, args.startDate, args.endDate, args.folder, args.checksum, args.workers, args.verify)
+    download_daily_klines(args.type, symbols, num_symbols, args.intervals, dates, args.startDate, args.endDate, args.folder, args.checksum, args.workers, args.verify)
 
@@ -6,6 +6,16 @@ DAILY_INTERVALS = ["1m", "5m", "15m", "30m", "1h", "2h", "4h", "6h", "8h", "12h"
 TRADING_TYPE = ["spot", "um", "cm"]
 MONTHS = list(range(1,13))
 MAX_DAYS = 35
+MAX_WORKERS = 16
+BLOCKSIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRY_AFTER = 60
+FAILED_LOG = '.failed.log'
+CONNECTION_TIMEOUT = 30
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
 BASE_URL = 'https://data.binance.vision/'
 START_DATE = date(int(YEARS[0]), MONTHS[0], 1)
 END_DATE = datetime.date(datetime.now())
\ No newline at end of file
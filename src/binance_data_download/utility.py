@@ -1,72 +1,351 @@
 import os, sys, re, shutil
-import json
+import hashlib
 from pathlib import Path
-import urllib.request
+import http.client
+import threading
+from time import sleep
+from functools import lru_cache
+from base64 import b64encode
+from urllib.parse import urlsplit, urljoin, unquote
+from urllib.request import getproxies, proxy_bypass
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from argparse import ArgumentParser, RawTextHelpFormatter, ArgumentTypeError
 from src.binance_data_download.enums import *
 
+# orjson parses the large exchangeInfo payloads several times faster, use it when it is installed
+try:
+  from orjson import loads as json_loads
+except ImportError:
+  from json import loads as json_loads
+
+# Resolved once at import, realpath costs a syscall per path component
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+
 def get_destination_dir(file_url, folder=None):
   store_directory = os.environ.get('STORE_DIRECTORY')
   if folder:
     store_directory = folder
   if not store_directory:
-    store_directory = os.path.dirname(os.path.realpath(__file__))
+    store_directory = SCRIPT_DIR
   return os.path.join(store_directory, file_url)
 
 def get_download_url(file_url):
   return "{}{}".format(BASE_URL, file_url)
 
+@lru_cache(maxsize=None)
+def get_proxy(scheme, host):
+  # Honour HTTP(S)_PROXY and NO_PROXY as urlopen did, returning the proxy address and its auth header if any
+  proxy = getproxies().get(scheme)
+  if not proxy or proxy_bypass(host):
+    return None, {}
+  parts = urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+  proxy_headers = {}
+  if parts.username:
+    credentials = '{}:{}'.format(unquote(parts.username), unquote(parts.password or ''))
+    proxy_headers['Proxy-Authorization'] = 'Basic ' + b64encode(credentials.encode()).decode()
+  return parts.hostname + (':{}'.format(parts.port) if parts.port else ''), proxy_headers
+
+# One keep-alive connection per (thread, host) so each download skips the TCP/TLS handshake
+connections = threading.local()
+
+def get_connection(scheme, host):
+  pool = connections.__dict__.setdefault('pool', {})
+  if (scheme, host) not in pool:
+    connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+    proxy, proxy_headers = get_proxy(scheme, host)
+    # the timeout stops a stalled socket from holding a worker forever, download_file retries it instead
+    if proxy is None:
+      connection = connection_class(host, timeout=CONNECTION_TIMEOUT)
+    else:
+      connection = connection_class(proxy, timeout=CONNECTION_TIMEOUT)
+      if scheme == 'https':
+        # tunnel through the proxy with CONNECT, so TLS is still end to end
+        connection.set_tunnel(host, headers=proxy_headers)
+    pool[(scheme, host)] = connection
+  return pool[(scheme, host)]
+
+def send_request(method, url, headers):
+  parts = urlsplit(url)
+  proxy, proxy_headers = get_proxy(parts.scheme, parts.netloc)
+  if proxy is not None and parts.scheme == 'http':
+    # a plain HTTP proxy is sent the absolute URL
+    target = url
+    headers = {**headers, **proxy_headers}
+  else:
+    target = parts.path + ('?' + parts.query if parts.query else '')
+  connection = get_connection(parts.scheme, parts.netloc)
+  try:
+    connection.request(method, target, headers=headers)
+    return connection.getresponse()
+  except (http.client.HTTPException, ConnectionError):
+    # the server closed the idle connection, reconnect once
+    connection.close()
+    connection.request(method, target, headers=headers)
+    return connection.getresponse()
+
+def http_request(method, url, headers={}):
+  # Follows redirects as urlopen did
+  for _ in range(MAX_REDIRECTS):
+    response = send_request(method, url, headers)
+    location = response.getheader('location')
+    if response.status not in REDIRECT_STATUSES or not location:
+      return response
+    # drain the body so the connection can be reused
+    response.read()
+    url = urljoin(url, location)
+  return send_request(method, url, headers)
+
+def http_get(url, headers={}):
+  return http_request('GET', url, headers)
+
 def get_all_symbols(type):
   if type == 'um':
-    response = urllib.request.urlopen("https://fapi.binance.com/fapi/v1/exchangeInfo").read()
+    url = "https://fapi.binance.com/fapi/v1/exchangeInfo"
   elif type == 'cm':
-    response = urllib.request.urlopen("https://dapi.binance.com/dapi/v1/exchangeInfo").read()
+    url = "https://dapi.binance.com/dapi/v1/exchangeInfo"
   else:
-    response = urllib.request.urlopen("https://api.binance.com/api/v3/exchangeInfo").read()
-  return list(map(lambda symbol: symbol['symbol'], json.loads(response)['symbols']))
+    url = "https://api.binance.com/api/v3/exchangeInfo"
+  response = http_get(url)
+  body = response.read()
+  if response.status != 200:
+    # e.g. a 403 or 451 when the API is blocked in this region, raised as urlopen did
+    raise HTTPError(url, response.status, response.reason, response.headers, None)
+  return [symbol['symbol'] for symbol in json_loads(body)['symbols']]
 
-def download_file(base_path, file_name, date_range=None, folder=None):
-  download_path = "{}{}".format(base_path, file_name)
+class DownloadReader:
+  # Wraps a response so shutil.copyfileobj hashes the body and drives the progress bar as it reads
+  def __init__(self, response, length, progress=True):
+    self.response = response
+    self.length = length
+    self.progress = progress
+    self.received = 0
+    self.done = -1
+    self.sha256 = hashlib.sha256()
+
+  def read(self, size=-1):
+    buf = self.response.read(size)
+    self.received += len(buf)
+    self.sha256.update(buf)
+    if self.progress and self.length:
+      done = int(50 * self.received / self.length)
+      # only redraw when the bar moves, not on every block
+      if done != self.done:
+        self.done = done
+        sys.stdout.write("\r[%s%s]" % ('#' * done, '.' * (50-done)) )
+        sys.stdout.flush()
+    return buf
+
+# Every file in a directory shares its base path, so the joins are only done once per directory
+@lru_cache(maxsize=4096)
+def get_save_dir(base_path, folder=None):
   if folder:
     base_path = os.path.join(folder, base_path)
+  return get_destination_dir(base_path, folder)
+
+def get_save_path(base_path, file_name, folder=None):
+  return os.path.join(get_save_dir(base_path, folder), file_name)
+
+# Directories made by this process, so each is only created once rather than once per file
+created_dirs = set()
+
+def make_directory(directory):
+  if directory not in created_dirs:
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    created_dirs.add(directory)
+
+def preallocate(out_file, length):
+  # Reserve the whole file up front so concurrent downloads do not fragment each other on disk
+  out_file.flush()
+  try:
+    if hasattr(os, 'posix_fallocate'):
+      os.posix_fallocate(out_file.fileno(), 0, length)
+    else:
+      os.ftruncate(out_file.fileno(), length)
+  except OSError:
+    # not supported by this filesystem, the file just grows as it is written
+    pass
+
+def verify_checksum(download_url, save_path, digest):
+  # Binance publishes "<sha256>  <file name>" next to every zip
+  response = http_get(download_url + '.CHECKSUM')
+  body = response.read()
+  if response.status == 404:
+    print("\nChecksum not found: {}.CHECKSUM".format(download_url))
+    return True
+  if response.status in RETRY_STATUSES:
+    raise RetryableResponse(response.status, response.getheader('retry-after'))
+  if response.status != 200:
+    # only a missing CHECKSUM means none is published, anything else leaves the zip unverified
+    raise http.client.HTTPException("HTTP {} for {}.CHECKSUM".format(response.status, download_url))
+  with open(save_path + '.CHECKSUM', 'wb') as checksum_file:
+    checksum_file.write(body)
+  return body.split()[0].decode().lower() == digest
+
+class RetryableResponse(http.client.HTTPException):
+  # Raised for statuses worth retrying, carrying the Retry-After header when the server sent one
+  def __init__(self, status, retry_after=None):
+    super().__init__("HTTP {}".format(status))
+    # capped, so a server asking for hours does not stall a worker for that long
+    self.retry_after = min(int(retry_after), MAX_RETRY_AFTER) if retry_after and retry_after.isdigit() else None
+
+def transfer_file(download_url, save_path, progress=True):
+  # Streams the file into save_path + '.part', continuing from the end of an earlier partial download
+  partial_path = save_path + '.part'
+  offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+  dl_file = http_get(download_url, {'Range': 'bytes={}-'.format(offset)} if offset else {})
+  if dl_file.status == 416:
+    # the partial file does not fit the remote file, start again from scratch
+    dl_file.read()
+    os.remove(partial_path)
+    return transfer_file(download_url, save_path, progress)
+  if dl_file.status in RETRY_STATUSES:
+    # throttled or a transient server error, download_file retries after a backoff
+    dl_file.read()
+    raise RetryableResponse(dl_file.status, dl_file.getheader('retry-after'))
+  if dl_file.status not in (200, 206):
+    # drain the body so the connection can be reused
+    dl_file.read()
+    print("\nFile not found: {}".format(download_url))
+    return None
+  if dl_file.status == 200:
+    # the server ignored the range and is sending the whole file
+    offset = 0
+
+  length = dl_file.getheader('content-length')
+  length = offset + int(length) if length else None
+  reader = DownloadReader(dl_file, length, progress)
+  reader.received = offset
+
+  with open(partial_path, 'r+b' if offset else 'wb', buffering=BLOCKSIZE) as out_file:
+    print("\nFile Download: {}".format(save_path))
+    if offset:
+      # the checksum covers the whole file, so hash the bytes kept from the earlier attempt first
+      for block in iter(lambda: out_file.read(BLOCKSIZE), b''):
+        reader.sha256.update(block)
+    if length:
+      preallocate(out_file, length)
+    try:
+      shutil.copyfileobj(reader, out_file, BLOCKSIZE)
+    finally:
+      # drop any preallocated space that was not written, e.g. if the transfer was cut short
+      out_file.truncate(out_file.tell())
+  if length is not None and reader.received != length:
+    # read() returns b'' instead of raising when the connection drops mid-body, download_file resumes the .part
+    raise http.client.IncompleteRead(b'', length - reader.received)
+  return reader
+
+def remote_size_matches(download_url, save_path):
+  # A HEAD costs one round trip and no body, enough to catch a truncated or stale file
+  response = http_request('HEAD', download_url)
+  response.read()
+  length = response.getheader('content-length')
+  if response.status != 200 or length is None:
+    # nothing to compare against, keep the file that is there
+    return True
+  return int(length) == os.path.getsize(save_path)
+
+def download_file(base_path, file_name, date_range=None, folder=None, progress=True, checksum=False,
+                  verify_existing=False):
+  download_path = "{}{}".format(base_path, file_name)
   # if date_range:
   #   date_range = date_range.replace(" ","_")
   #   base_path = os.path.join(base_path, date_range)
-  save_path = get_destination_dir(os.path.join(base_path, file_name), folder)
+  save_path = get_save_path(base_path, file_name, folder)
   
 
   if os.path.exists(save_path):
-    print("\nfile already exists! {}".format(save_path))
-    return
+    if not verify_existing or remote_size_matches(get_download_url(download_path), save_path):
+      print("\nfile already exists! {}".format(save_path))
+      return
+    # the download below replaces the file once it is complete
+    print("\nfile size does not match the remote file, downloading again: {}".format(save_path))
   
   # make the directory
-  if not os.path.exists(base_path):
-    Path(get_destination_dir(base_path)).mkdir(parents=True, exist_ok=True)
+  make_directory(os.path.dirname(save_path))
+
+  download_url = get_download_url(download_path)
+  reader = None
+  for attempt in range(DOWNLOAD_RETRIES):
+    try:
+      if reader is None:
+        reader = transfer_file(download_url, save_path, progress)
+        if reader is None:
+          return
+      # the zip was hashed as it streamed, so verifying only costs fetching the small CHECKSUM file. It is checked
+      # before the rename, so a zip whose check failed or could not be fetched is never left looking complete
+      if checksum and not verify_checksum(download_url, save_path, reader.sha256.hexdigest()):
+        print("\nChecksum mismatch, removing {}".format(save_path))
+        os.remove(save_path + '.part')
+        return
+      break
+    except (http.client.HTTPException, OSError) as error:
+      # whatever reached the .part file is kept, so the next attempt only fetches the rest
+      if attempt == DOWNLOAD_RETRIES - 1:
+        raise
+      print("\nDownload interrupted ({}), retrying: {}".format(error, download_url))
+      retry_after = getattr(error, 'retry_after', None)
+      sleep(retry_after if retry_after is not None else BACKOFF_FACTOR * 2 ** attempt)
+
+  # only complete files get the real name, so an interrupted download is never mistaken for a finished one
+  os.replace(save_path + '.part', save_path)
 
+def list_directory(directory):
   try:
-    download_url = get_download_url(download_path)
-    dl_file = urllib.request.urlopen(download_url)
-    length = dl_file.getheader('content-length')
-    if length:
-      length = int(length)
-      blocksize = max(4096,length//100)
-
-    with open(save_path, 'wb') as out_file:
-      dl_progress = 0
-      print("\nFile Download: {}".format(save_path))
-      while True:
-        buf = dl_file.read(blocksize)   
-        if not buf:
-          break
-        dl_progress += len(buf)
-        out_file.write(buf)
-        done = int(50 * dl_progress / length)
-        sys.stdout.write("\r[%s%s]" % ('#' * done, '.' * (50-done)) )    
+    return {entry.name for entry in os.scandir(directory)}
+  except FileNotFoundError:
+    # forget the directory if it has been deleted since it was made, e.g. by delete_historical_data
+    created_dirs.discard(directory)
+    return set()
+
+def download_files(jobs, date_range=None, folder=None, checksum=False, max_workers=MAX_WORKERS,
+                   verify_existing=False):
+  # the same symbol, interval or date given twice would otherwise have two threads writing the same file
+  jobs = list(dict.fromkeys(jobs))
+  # List each destination directory once rather than stat-ing every file
+  existing = {}
+  pending = []
+  skipped = []
+  for base_path, file_name in jobs:
+    save_dir = os.path.dirname(get_save_path(base_path, file_name, folder))
+    if save_dir not in existing:
+      existing[save_dir] = list_directory(save_dir)
+    # existing files are only checked against the remote size (one HEAD each) when asked to
+    if file_name in existing[save_dir] and not verify_existing:
+      skipped.append("file already exists! {}".format(os.path.join(save_dir, file_name)))
+    else:
+      pending.append((base_path, file_name))
+  if skipped:
+    print("\n" + "\n".join(skipped))
+
+  # Progress bars from concurrent downloads would overwrite each other, so only draw them when running serially
+  progress = max_workers == 1
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = {executor.submit(download_file, base_path, file_name, date_range, folder, progress, checksum,
+                               verify_existing):
+               base_path + file_name for base_path, file_name in pending}
+    # as_completed yields in this thread, so the counter needs no lock
+    failed = []
+    for completed, future in enumerate(as_completed(futures), start=1):
+      try:
+        future.result()
+      except (http.client.HTTPException, OSError) as error:
+        # one file running out of retries should not abort the rest of the grid
+        print("\nDownload failed ({}): {}".format(error, futures[future]))
+        failed.append(get_download_url(futures[future]))
+      if not progress:
+        sys.stdout.write("\r[{}/{}] files done".format(completed, len(futures)))
         sys.stdout.flush()
 
-  except urllib.error.HTTPError:
-    print("\nFile not found: {}".format(download_url))
-    pass
+  # the log lists what is still missing after this run, re-running the same command fetches only these and
+  # removes the log once nothing is left
+  log_path = get_destination_dir(FAILED_LOG, folder)
+  if failed:
+    with open(log_path, 'w') as log:
+      log.writelines(url + '\n' for url in failed)
+    print("\n{} files failed to download, see {}".format(len(failed), log_path))
+  elif os.path.exists(log_path):
+    os.remove(log_path)
 
 def convert_to_date_object(d):
   year, month, day = [int(x) for x in d.split('-')]
@@ -79,8 +358,11 @@ def get_start_end_date_objects(date_range):
   end_date = convert_to_date_object(end)
   return start_date, end_date
 
-def match_date_regex(arg_value, pat=re.compile(r'\d{4}-\d{2}-\d{2}')):
-  if not pat.match(arg_value):
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+def match_date_regex(arg_value):
+  # fullmatch so trailing characters such as '2021-01-01junk' are rejected
+  if not DATE_PATTERN.fullmatch(arg_value):
     raise ArgumentTypeError
   return arg_value
 
@@ -98,15 +380,78 @@ def check_directory(arg_value):
         break
   return arg_value
 
-def get_path(trading_type, market_data_type, time_period, symbol, interval=None):
+def check_workers(arg_value):
+  # a thread pool needs at least one worker
+  workers = int(arg_value)
+  if workers < 1:
+    raise ArgumentTypeError('must be at least 1')
+  return workers
+
+def path_builder(trading_type, market_data_type, time_period):
+  # Resolve the parts of the path shared by every file once, returning a function that fills in the rest
   trading_type_path = 'data/spot'
   if trading_type != 'spot':
     trading_type_path = f'data/futures/{trading_type}'
-  if interval is not None:
-    path = f'{trading_type_path}/{time_period}/{market_data_type}/{symbol.upper()}/{interval}/'
-  else:
-    path = f'{trading_type_path}/{time_period}/{market_data_type}/{symbol.upper()}/'
-  return path
+  prefix = f'{trading_type_path}/{time_period}/{market_data_type}'
+
+  def build_path(symbol, interval=None):
+    if interval is not None:
+      return f'{prefix}/{symbol.upper()}/{interval}/'
+    return f'{prefix}/{symbol.upper()}/'
+
+  return build_path
+
+def get_path(trading_type, market_data_type, time_period, symbol, interval=None):
+  return path_builder(trading_type, market_data_type, time_period)(symbol, interval)
+
+def get_date_range(start_date, end_date):
+  if start_date and end_date:
+    return start_date + " " + end_date
+  return None
+
+def get_date_bounds(start_date, end_date):
+  start_date = convert_to_date_object(start_date) if start_date else START_DATE
+  end_date = convert_to_date_object(end_date) if end_date else END_DATE
+  return start_date, end_date
+
+def plan_monthly_downloads(trading_type, market_data_type, symbols, num_symbols, years, months, start_date, end_date, intervals=(None,)):
+  # Only builds the (path, file_name) jobs so that several plans can be handed to a single download_files call
+  start_date, end_date = get_date_bounds(start_date, end_date)
+  periods = [(year, month) for year in years for month in months
+             if start_date <= date(int(year), int(month), 1) <= end_date]
+  build_path = path_builder(trading_type, market_data_type, "monthly")
+  jobs = []
+  status = ["Found {} symbols".format(num_symbols)]
+
+  for current, symbol in enumerate(symbols):
+    status.append("[{}/{}] - start download monthly {} {} ".format(current+1, num_symbols, symbol, market_data_type))
+    for interval in intervals:
+      path = build_path(symbol, interval)
+      # everything before the date is shared by the files of a symbol and interval
+      name_prefix = "{}-{}-".format(symbol.upper(), interval or market_data_type)
+      for year, month in periods:
+        jobs.append((path, "{}{}-{:02d}.zip".format(name_prefix, year, month)))
+
+  print("\n".join(status))
+  return jobs
+
+def plan_daily_downloads(trading_type, market_data_type, symbols, num_symbols, dates, start_date, end_date, intervals=(None,)):
+  start_date, end_date = get_date_bounds(start_date, end_date)
+  dates = [d for d in dates if start_date <= d <= end_date]
+  build_path = path_builder(trading_type, market_data_type, "daily")
+  jobs = []
+  status = ["Found {} symbols".format(num_symbols)]
+
+  for current, symbol in enumerate(symbols):
+    status.append("[{}/{}] - start download daily {} {} ".format(current+1, num_symbols, symbol, market_data_type))
+    for interval in intervals:
+      path = build_path(symbol, interval)
+      name_prefix = "{}-{}-".format(symbol.upper(), interval or market_data_type)
+      for d in dates:
+        jobs.append((path, "{}{}.zip".format(name_prefix, d.isoformat())))
+
+  print("\n".join(status))
+  return jobs
 
 def get_parser(parser_type):
   parser = ArgumentParser(description=("This is a script to download historical {} data").format(parser_type), formatter_class=RawTextHelpFormatter)
@@ -133,7 +478,13 @@ def get_parser(parser_type):
       help='Directory to store the downloaded data')
   parser.add_argument(
       '-c', dest='checksum', default=0, type=int, choices=[0,1],
-      help='1 to download checksum file, default 0')
+      help='1 to verify new downloads against their checksum file, existing files are not checked, default 0')
+  parser.add_argument(
+      '-w', dest='workers', default=MAX_WORKERS, type=check_workers,
+      help='Number of files to download concurrently, default {}'.format(MAX_WORKERS))
+  parser.add_argument(
+      '-v', dest='verify', default=0, type=int, choices=[0,1],
+      help='1 to check existing files against the remote size and download them again if it differs, default 0')
   parser.add_argument(
       '-t', dest='type', default='spot', choices=TRADING_TYPE,
       help='Valid trading types: {}'.format(TRADING_TYPE))
@@ -1,16 +1,150 @@
 # Imports from standard libraries
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache
 import os
 import shutil
+import tempfile
+import zipfile
+import numpy as np
 import pandas as pd
 
 # Imports from binance download libraries
-from binance_data_download.download_kline import download_daily_klines
 from binance_data_download.download_trade import download_daily_trades
+from binance_data_download.enums import DAILY_INTERVALS
+from binance_data_download.utility import download_files, plan_daily_downloads
+
+# Columns of the Binance kline CSVs
+KLINE_COLUMNS = ['open time', 'open', 'high', 'low', 'close', 'volume', 'close time', 'quote asset volume',
+                 'number of trades', 'taker buy asset volume', 'taker buy quote asset volume', 'ignore']
+KLINE_DTYPES = {'open time': 'int64', 'open': 'float64', 'high': 'float64', 'low': 'float64', 'close': 'float64',
+                'volume': 'float64', 'close time': 'int64', 'quote asset volume': 'float64',
+                'number of trades': 'int64', 'taker buy asset volume': 'float64',
+                'taker buy quote asset volume': 'float64'}
+
+# Columns of the Binance trade CSVs and the dtypes of those used when collating
+TRADE_COLUMNS = ["tradeID", "price", "qty", "quoteQty", "time", "isBuyerMaker", "isBestMatch"]
+TRADE_DTYPES = {"price": "float64", "qty": "float64", "quoteQty": "float64", "time": "int64"}
+
+# pyarrow's CSV parser is multithreaded, fall back to the pandas C parser when it is not installed
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = pa_csv = None
 
 # ----------------------------------------------- Utility functions -----------------------------------------------
 
 
+def parquet_cache_path(filepath):
+    """
+    Returns the path of the parquet copy of a downloaded zip file, kept under test_data/binance/.cache, or None for
+    files outside test_data/binance, which are not cached
+
+    :param filepath: The pathname of the zip file
+    """
+    head, sep, tail = filepath.partition("/test_data/binance/")
+    if not sep:
+        return None
+    return f"{head}{sep}.cache/{os.path.splitext(tail)[0]}.parquet"
+
+
+def read_parquet_cached(filepath, parse, columns=None):
+    """
+    Parses a downloaded zip file, reading the parquet copy written by an earlier call instead while the zip is
+    unchanged
+
+    :param filepath: The pathname of the zip file
+    :param parse: Function parsing the zip file into a DataFrame of every column that may be requested
+    :param columns: The columns to be returned, all columns if None
+    """
+    cache_path = parquet_cache_path(filepath)
+    if cache_path is None:
+        df = parse(filepath)
+        return df if columns is None else df[columns]
+
+    # The cache is stamped with the modification time of the zip it was parsed from, so a zip that has been
+    # downloaded again is parsed again (and a deleted zip raises rather than being served from the cache)
+    zip_mtime = os.stat(filepath).st_mtime_ns
+    if os.path.exists(cache_path) and os.stat(cache_path).st_mtime_ns == zip_mtime:
+        return pd.read_parquet(cache_path, columns=columns)
+
+    df = parse(filepath)
+    # The cache only saves parsing time, so failing to write it (e.g. a full or read-only disk) still returns df
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Writing to a uniquely named temporary file first so an interrupted write never leaves a truncated cache
+        # file behind, and two processes parsing the same zip do not write into each other's file
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+        os.close(fd)
+        try:
+            df.to_parquet(tmp_path, compression="zstd", index=False)
+            os.utime(tmp_path, ns=(zip_mtime, zip_mtime))
+            os.replace(tmp_path, cache_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    except OSError:
+        pass
+    return df if columns is None else df[columns]
+
+
+def read_zipped_csv(filename, column_names, dtypes):
+    """
+    Reads the CSV in a Binance zip file with pyarrow's multithreaded parser, only parsing the columns in dtypes
+
+    :param filename: The pathname of the zip file
+    :param column_names: The names of every column of the CSV, which has no header
+    :param dtypes: Dictionary of the columns to be read and their dtypes
+    """
+    # Decompressing the single CSV in the archive into memory and handing it to pyarrow's parser
+    with zipfile.ZipFile(filename) as archive:
+        csv_bytes = archive.read(archive.namelist()[0])
+    table = pa_csv.read_csv(pa.BufferReader(csv_bytes),
+                            read_options=pa_csv.ReadOptions(column_names=column_names),
+                            convert_options=pa_csv.ConvertOptions(
+                                include_columns=list(dtypes),
+                                column_types={name: pa.type_for_alias(dtype) for name, dtype in dtypes.items()}))
+    # Freeing each Arrow column as it is converted so the table and the DataFrame are not both held in full
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+def read_trade_file_pandas(filename, nrows=None):
+    """
+    Reads the collated columns of a zipped trade CSV with the pandas C parser
+
+    :param filename: The pathname of the zip file
+    :param nrows: The maximum number of rows imported, all rows if None
+    """
+    return pd.read_csv(filename, compression='zip', header=None, names=TRADE_COLUMNS, usecols=list(TRADE_DTYPES),
+                       dtype=TRADE_DTYPES, engine='c', nrows=nrows)
+
+
+def read_trade_file(filename):
+    """
+    Reads the collated columns of a zipped trade CSV, using pyarrow when it is installed
+
+    :param filename: The pathname of the zip file
+    """
+    if pa_csv is None:
+        return read_trade_file_pandas(filename)
+    return read_parquet_cached(filename, lambda path: read_zipped_csv(path, TRADE_COLUMNS, TRADE_DTYPES))
+
+
+def run_sums(values, starts):
+    """
+    Returns the sum of each contiguous run of values
+
+    :param values: 1D numpy array
+    :param starts: Sorted indices at which each run starts, the first being 0
+    """
+    # reduceat needs at least one index, an empty file has no runs
+    if len(starts) == 0:
+        return values[:0]
+    return np.add.reduceat(values, starts)
+
+
 def trade_data_collation(filename, symbol, limit_rows=False, nrows=50000):
     """
     Collates trade data from csv file into 10 second intervals
@@ -20,28 +154,115 @@ def trade_data_collation(filename, symbol, limit_rows=False, nrows=50000):
     :param filename: the pathname of the csv files
     :param symbol: associated symbol of trade data
     """
-    # Read CSV file
+    # Read CSV file, only parsing the columns used in the collation
     if limit_rows:
-        df = pd.read_csv(filename, compression='zip', header=None, sep=',', quotechar='"',
-                         names=["tradeID", "price", "qty", "quoteQty", "time", "isBuyerMaker", "isBestMatch"],
-                         nrows=nrows)
+        df = read_trade_file_pandas(filename, nrows=nrows)
     else:
-        df = pd.read_csv(filename, compression='zip', header=None, sep=',', quotechar='"',
-                             names=["tradeID", "price", "qty", "quoteQty", "time", "isBuyerMaker", "isBestMatch"])
-
-    # Floors time to 10 seconds and then converts back to milliseconds
-    df["time"] = df["time"].floordiv(10000) * 10000
-    # Grouping data and suming and averaging necessary columns
-    df = df.groupby("time", as_index=False).agg({'price': 'mean', 'qty': 'sum', 'quoteQty': 'sum'})
-    # Add symbol column
-    df["symbol"] = symbol
+        df = read_trade_file(filename)
+
+    # Floors time to 10 seconds and then converts back to milliseconds, working on a single int64 array
+    time_ms = df["time"].to_numpy(copy=True)
+    np.floor_divide(time_ms, 10000, out=time_ms)
+    np.multiply(time_ms, 10000, out=time_ms)
+    # Grouping data and suming and averaging necessary columns. Binance trade files are in time order, so each
+    # bucket is a contiguous run that can be reduced in one pass without sorting or hashing
+    if np.any(time_ms[1:] < time_ms[:-1]):
+        order = np.argsort(time_ms, kind="stable")
+        time_ms = time_ms[order]
+        df = df.iloc[order]
+    starts = np.flatnonzero(np.diff(time_ms, prepend=time_ms[:1] - 1))
+    counts = np.diff(np.append(starts, len(time_ms)))
+    df = pd.DataFrame({"time": time_ms[starts],
+                       "price": run_sums(df["price"].to_numpy(), starts) / counts,
+                       "qty": run_sums(df["qty"].to_numpy(), starts),
+                       "quoteQty": run_sums(df["quoteQty"].to_numpy(), starts)})
+    # Add symbol column, categorical so it is one code per row rather than one string
+    df["symbol"] = constant_categorical(symbol, len(df), pd.CategoricalDtype([symbol]))
     # Return DataFrame
     return df
 
 
+def read_kline_file(filepath, columns=None):
+    """
+    Reads a single zipped kline CSV
+
+    :param filepath: The pathname of the zip file
+    :param columns: The columns to be read, all but the unused 'ignore' column if None
+    """
+    usecols = list(KLINE_DTYPES) if columns is None else columns
+    # Only the columns in KLINE_DTYPES are parsed (and cached), so anything else is rejected the same way whether
+    # or not pyarrow is installed
+    unknown = [column for column in usecols if column not in KLINE_DTYPES]
+    if unknown:
+        raise ValueError("Kline columns not recognised or not read: {}".format(unknown))
+    if pa is None:
+        return pd.read_csv(filepath, compression='zip', names=KLINE_COLUMNS, usecols=usecols,
+                           dtype={column: KLINE_DTYPES[column] for column in usecols})
+
+    # Caching every used column so later reads can select any subset
+    return read_parquet_cached(filepath, lambda path: read_zipped_csv(path, KLINE_COLUMNS, KLINE_DTYPES), usecols)
+
+
+def parallel_map(executor_class, function, *iterables):
+    """
+    Maps the function over the iterables with a pool from executor_class, or serially in this process when there
+    is only one job or the RESEARCHTOOLS_PARALLEL environment variable is set to 0 (e.g. to debug or profile the
+    function)
+
+    :param executor_class: ThreadPoolExecutor or ProcessPoolExecutor
+    :param function: The function to be mapped
+    :param iterables: The arguments of the function, as for map
+    :return: Returns a list of the results in order
+    """
+    iterables = [list(iterable) for iterable in iterables]
+    jobs = min(map(len, iterables), default=0)
+    if jobs <= 1 or os.environ.get("RESEARCHTOOLS_PARALLEL", "1") == "0":
+        return list(map(function, *iterables))
+    # Never starting more workers than there are jobs, for a ProcessPoolExecutor each worker is a whole process
+    cpus = os.cpu_count() or 1
+    max_workers = cpus if executor_class is ProcessPoolExecutor else min(32, cpus + 4)
+    with executor_class(max_workers=min(jobs, max_workers)) as executor:
+        return list(executor.map(function, *iterables))
+
+
+def constant_categorical(value, length, dtype):
+    """
+    Returns a categorical column of the given length holding a single value
+
+    :param value: The value repeated down the column
+    :param length: The number of rows in the column
+    :param dtype: The CategoricalDtype of the column, must contain value
+    """
+    return pd.Categorical.from_codes(np.full(length, dtype.categories.get_loc(value)), dtype=dtype)
+
+
+def frames_in_order(frames, column):
+    """
+    Returns whether concatenating the frames in order gives a sorted column, assuming each frame is already sorted
+
+    :param frames: List of DataFrames, each sorted by column
+    :param column: The column to check
+    """
+    bounds = [(frame[column].iat[0], frame[column].iat[-1]) for frame in frames if len(frame) > 0]
+    return all(last <= first for (_, last), (first, _) in zip(bounds, bounds[1:]))
+
+
+@lru_cache(maxsize=128)
+def daily_date_strs(start_date, end_date):
+    """
+    Returns a tuple of the dates between the start and end date (inclusive) formatted as in the Binance file names
+
+    :params start_date: The start date in the format YYYY-MM-DD
+    :params end_date: The end date in the format YYYY-MM-DD
+    """
+    start_date = datetime.strptime(start_date, "%Y-%m-%d")
+    end_date = datetime.strptime(end_date, "%Y-%m-%d")
+    return tuple(date.strftime("%Y-%m-%d") for date in pd.date_range(start_date, end_date, freq='d'))
+
+
 def downloaded_filepaths(type_, start_date, end_date, symbol_data_required):
     """
-    Returns dictionary of downloaded data with key of filepath and value of (symbol, interval)
+    Returns a list of (filepath, symbol, interval) tuples of the downloaded data, in file order
 
     :params type_: Either klines or trades, depending on the needed data
     :params start_date: The start date of the requested data
@@ -49,65 +270,68 @@ def downloaded_filepaths(type_, start_date, end_date, symbol_data_required):
     :symbol_data_required: The symbols required for the backtest
     """
 
-    # Getting list of relevant dates
-    start_date = datetime.strptime(start_date, "%Y-%m-%d")
-    end_date = datetime.strptime(end_date, "%Y-%m-%d")
-    date_range = pd.date_range(start_date, end_date, freq='d')
-
-    # Iterating over required files and adding to dictionary
-    file_format = "{}/test_data/binance/data/spot/daily/{}/{}/{}-{}-{}.zip"
-    filepaths = dict()
-
-    for symbol in symbol_data_required.keys():
-        if len(symbol_data_required[symbol]) > 0:
-            for interval in symbol_data_required[symbol]:
-                for date in date_range:
-                    date_format = date.strftime("%Y-%m-%d")
-                    if type_ == "klines":
-                        filepath = file_format.format(os.getcwd(), type_, "{}/{}".format(symbol, interval), symbol,
-                                                      interval, date_format)
-                    elif type_ == "trades":
-                        filepath = file_format.format(os.getcwd(), type_, symbol, symbol, type_, date_format)
-                    else:
-                        raise ValueError("Tried to det filepaths of type that was not recognised: type={}".format(type_))
-                    filepaths[filepath] = (symbol, interval)
-        else:
-            for date in date_range:
-                date_format = date.strftime("%Y-%m-%d")
-                if type_ == "trades":
-                    filepath = file_format.format(os.getcwd(), type_, symbol, symbol, type_, date_format)
-                filepaths[filepath] = (symbol, None)
-
-    return filepaths
+    # Getting list of relevant dates, formatted once per date range
+    date_strs = daily_date_strs(start_date, end_date)
+
+    # Resolving the working directory once rather than once per file
+    base_path = f"{os.getcwd()}/test_data/binance/data/spot/daily/{type_}"
+
+    # Building the path prefix of each symbol (and interval) once, only the date changes between files
+    if type_ == "klines":
+        prefixes = [(f"{base_path}/{symbol}/{interval}/{symbol}-{interval}-", symbol, interval)
+                    for symbol, intervals in symbol_data_required.items()
+                    for interval in dict.fromkeys(intervals)]
+    elif type_ == "trades":
+        prefixes = [(f"{base_path}/{symbol}/{symbol}-trades-", symbol, None)
+                    for symbol in symbol_data_required.keys()]
+    else:
+        raise ValueError("Tried to det filepaths of type that was not recognised: type={}".format(type_))
+
+    # Building the list of required files
+    return [(f"{prefix}{date_str}.zip", symbol, interval)
+            for prefix, symbol, interval in prefixes
+            for date_str in date_strs]
 
 # ----------------------------------------------- Get Historical Data -----------------------------------------------
 
 
-def get_binance_kline_data(start_date, end_date, symbol_data_required):
+def get_binance_kline_data(start_date, end_date, symbol_data_required, columns=None):
     """
     Used to get binance market data
 
     :param start_date: The start date of the data wanting the be obtained
     :param end_date: The finish date of the data wanting the be obtained
     :param symbol_data_required: Dictionary containing symbols as keys and list of intervals as values
+    :param columns: The kline columns to be read, all but 'ignore' if None ('close time' is always read)
     :return: Returns a pandas DataFrame of the data
     """
-    # Headers for the CSV
-    headers = ['open time', 'open', 'high', 'low', 'close', 'volume', 'close time', 'quote asset volume',
-               'number of trades', 'taker buy asset volume', 'taker buy quote asset volume', 'ignore']
+    # Close time is needed to order the data
+    if columns is not None and 'close time' not in columns:
+        columns = [*columns, 'close time']
 
-    # Creating DataFrame
-    kline_data = pd.DataFrame()
+    # Collecting the per-file DataFrames so they are concatenated once
+    frames = []
 
-    # Iterating over downloaded files
+    # Sharing the categories across files keeps symbol and interval categorical through the concat
     filepaths = downloaded_filepaths("klines", start_date, end_date, symbol_data_required)
-    for filepath in filepaths.keys():
-        part_df = pd.read_csv(filepath, compression='zip', names=headers)
-        part_df["symbol"] = filepaths[filepath][0]
-        part_df["interval"] = filepaths[filepath][1]
-        kline_data = kline_data.append(part_df)
+    symbol_dtype = pd.CategoricalDtype(list(dict.fromkeys(symbol for _, symbol, _ in filepaths)))
+    interval_dtype = pd.CategoricalDtype(list(dict.fromkeys(interval for _, _, interval in filepaths)))
+
+    # Reading the downloaded files concurrently, zip decompression and the C parser release the GIL
+    parts = parallel_map(ThreadPoolExecutor, lambda filepath: read_kline_file(filepath, columns),
+                         [filepath for filepath, _, _ in filepaths])
+
+    for part_df, (_, symbol, interval) in zip(parts, filepaths):
+        part_df["symbol"] = constant_categorical(symbol, len(part_df), symbol_dtype)
+        part_df["interval"] = constant_categorical(interval, len(part_df), interval_dtype)
+        frames.append(part_df)
+
+    kline_data = pd.concat(frames, ignore_index=True)
 
-    kline_data = kline_data.sort_values(by="close time")
+    # Each file is already sorted and they are read in date order, so a sort is only needed when files overlap
+    # in time (several symbols or intervals), where mergesort can take advantage of the sorted runs
+    if not frames_in_order(frames, "close time"):
+        kline_data = kline_data.sort_values(by="close time", kind="mergesort")
     return kline_data
 
 
@@ -115,42 +339,51 @@ def get_binance_trade_data(start_date, end_date, symbols):
     """
     Used to get trade data and collate it into 10 second intervals
     - For now only uses established filenames
+    - Several files are collated in worker processes, so on platforms that spawn them (macOS, Windows) scripts
+      calling this need an if __name__ == "__main__" guard
 
     :param symbols: List of symbols wanting to be received
     :param end_date: The end date
     :param start_date: The start date
     :return: Returns a pandas DataFrame of the data
     """
-    # Initialize DataFrame
-    trade_data = pd.DataFrame()
-
     # Changing symbols list to dictionary
     symbols_dict = dict()
     for symbol in symbols:
         symbols_dict[symbol] = []
 
-    # Get filepaths dictionary
+    # Get filepaths
     filepaths = downloaded_filepaths("trades", start_date, end_date, symbols_dict)
 
-    # Iterate through filepaths
-    for filepath in filepaths.keys():
-        # Importing data with debug features
-        part_data = trade_data_collation(filepath, filepaths[filepath][0])
-        trade_data = trade_data.append(part_data, ignore_index=True)
+    # Collate the files in parallel, each file is parsed and grouped independently of the others
+    frames = parallel_map(ProcessPoolExecutor, trade_data_collation, [filepath for filepath, _, _ in filepaths],
+                          [symbol for _, symbol, _ in filepaths])
+
+    # Sharing the symbol categories across files keeps the column categorical through the concat
+    symbol_dtype = pd.CategoricalDtype(list(symbols_dict))
+    for frame in frames:
+        frame["symbol"] = frame["symbol"].cat.set_categories(symbol_dtype.categories)
 
     # Return trade data
-    return trade_data.sort_values(by="time")
+    trade_data = pd.concat(frames, ignore_index=True)
+
+    # Each collated file is already sorted by time, so a sort is only needed when files overlap in time (several
+    # symbols), where mergesort merges the sorted runs rather than sorting from scratch
+    if not frames_in_order(frames, "time"):
+        trade_data = trade_data.sort_values(by="time", kind="mergesort")
+    return trade_data
 
 # -------------------------------------------- Downloading Data Methods --------------------------------------------
 
 
-def download_binance_trade_data(symbols: list, start_date, end_date):
+def download_binance_trade_data(symbols: list, start_date, end_date, verify_existing=False):
     """
     Used to download trade data from Binance.
 
     :param start_date: The start date
     :param end_date: The end date
     :param symbols: list of symbols to be downloaded
+    :param verify_existing: If True existing files are downloaded again when their size differs from the remote file
     """
     print("\n----------------------------------- Downloading Historical Data -----------------------------------")
 
@@ -158,24 +391,25 @@ def download_binance_trade_data(symbols: list, start_date, end_date):
 
     # for symbol in symbol_data_required.keys():
     # Get all dates between two dates
-    dates = pd.date_range(start=start_date, end=end_date, freq='D').to_pydatetime().tolist()
-    dates = [date.strftime("%Y-%m-%d") for date in dates]
+    dates = list(pd.date_range(start=start_date, end=end_date, freq='D').date)
 
     # Download daily data
     download_daily_trades(trading_type='spot', symbols=symbols, num_symbols=len(symbols), dates=dates,
-                          start_date=start_date, end_date=end_date, folder=trades_base_path, checksum=0)
+                          start_date=start_date, end_date=end_date, folder=trades_base_path, checksum=0,
+                          verify_existing=verify_existing)
 
     print("\n----------------------------------- Finished Downloading Historical Data ---------"
           "--------------------------\n")
 
 
-def download_binance_kline_data(symbol_data_required: dict, start_date, end_date):
+def download_binance_kline_data(symbol_data_required: dict, start_date, end_date, verify_existing=False):
     """
     Used to download kline data from Binance.
 
     :param start_date: The start date
     :param end_date: The end date
     :param symbol_data_required: Dictionary with symbols as keys and a list of required intervals as values
+    :param verify_existing: If True existing files are downloaded again when their size differs from the remote file
     """
     print("\n----------------------------------- Downloading Historical Data -----------------------------------")
 
@@ -183,15 +417,18 @@ def download_binance_kline_data(symbol_data_required: dict, start_date, end_date
 
     # for symbol in symbol_data_required.keys():
     # Get all dates between two dates
-    dates = pd.date_range(start=start_date, end=end_date, freq='D').to_pydatetime().tolist()
-    dates = [date.strftime("%Y-%m-%d") for date in dates]
+    dates = list(pd.date_range(start=start_date, end=end_date, freq='D').date)
 
-    # Iterate through intervals
+    # Planning the files of every symbol first so they are all downloaded by one pool, rather than one pool
+    # per symbol that has to finish before the next symbol starts
+    jobs = []
     for symbol, intervals in symbol_data_required.items():
-        # Download interval data
-        download_daily_klines(trading_type='spot', symbols=[symbol], num_symbols=1, intervals=intervals,
-                              dates=dates, start_date=start_date, end_date=end_date, folder=kline_base_path,
-                              checksum=0)
+        intervals = [interval for interval in intervals if interval in DAILY_INTERVALS]
+        jobs += plan_daily_downloads(trading_type='spot', market_data_type='klines', symbols=[symbol], num_symbols=1,
+                                     dates=dates, start_date=start_date, end_date=end_date, intervals=intervals)
+
+    # Download interval data
+    download_files(jobs, folder=kline_base_path, verify_existing=verify_existing)
 
     print("\n----------------------------------- Finished Downloading Historical Data ---------"
           "--------------------------\n")
@@ -25,17 +25,16 @@ def get_trade_data_plot(symbols: list, start_date: str, end_date: str):
         # Make subplot figure
         fig = make_subplots(rows=len(symbols), cols=1, x_title='Time (UNIX)', y_title='Price')
 
-        # row counter
-        row_count = 1
+        # Get trade data for every symbol at once and split it, rather than reading the files once per symbol
+        trade_data = get_binance_trade_data(start_date=start_date, end_date=end_date, symbols=symbols)
+        trades_by_symbol = dict(tuple(trade_data.groupby("symbol", observed=True, sort=False)))
 
-        # Iterate through symbols
-        for symbol in symbols:
-            # Get trade data
-            trade_data = get_binance_trade_data(start_date=start_date, end_date=end_date, symbols=[symbol])
+        # Build a trace per symbol, WebGL traces stay responsive with many points
+        traces = [go.Scattergl(x=trades_by_symbol[symbol]['time'], y=trades_by_symbol[symbol]['price'],
+                               name="{}".format(symbol), mode='lines') for symbol in symbols]
 
-            # Add plot to figure and increment row count
-            fig.append_trace(go.Scatter(x=trade_data['time'], y=trade_data['price'], name="{}".format(symbol)), row=row_count, col=1)
-            row_count += 1
+        # Add plots to figure in one call, one row per symbol
+        fig.add_traces(traces, rows=list(range(1, len(traces) + 1)), cols=[1] * len(traces))
 
         # Update title and print output
         # fig.update_layout(title_text="Trade data")
@@ -43,7 +42,7 @@ def get_trade_data_plot(symbols: list, start_date: str, end_date: str):
     else:
         # Create figure
         fig = px.line(get_binance_trade_data(start_date=start_date, end_date=end_date, symbols=[symbols[0]]), x='time',
-                      y='price')
+                      y='price', render_mode='webgl')
         return fig
 
 # ------------------------------------ Plotting Kline Data ------------------------------------
@@ -59,15 +58,27 @@ def get_kline_data_plot(symbols_intervals: list, start_date: str, end_date: str)
     :return: Returns plot
     """
     fig = make_subplots(rows=len(symbols_intervals))
-    row_count = 1
+
+    # Get the klines for every (symbol, interval) in a single read and split them, rather than one read per plot
+    symbol_data_required = dict()
+    for (symbol, interval) in symbols_intervals:
+        symbol_data_required.setdefault(symbol, []).append(interval)
+    kline_data = get_binance_kline_data(start_date=start_date, end_date=end_date, symbol_data_required=symbol_data_required,
+                                        columns=['open', 'high', 'low', 'close', 'close time'])
+    klines_by_pair = dict(tuple(kline_data.groupby(["symbol", "interval"], observed=True, sort=False)))
+
+    traces = []
     for (symbol, interval) in symbols_intervals:
-        kline_data = get_binance_kline_data(start_date=start_date, end_date=end_date, symbol_data_required={symbol: [interval]})
-        fig_temp = go.Candlestick(x=kline_data['close time'], open=kline_data['open'], high=kline_data['high'],
-                                     low=kline_data['low'], close=kline_data['close'])
+        pair_klines = klines_by_pair[(symbol, interval)]
+        traces.append(go.Candlestick(x=pair_klines['close time'], open=pair_klines['open'], high=pair_klines['high'],
+                                     low=pair_klines['low'], close=pair_klines['close']))
         # fig_temp.update(fig.update_layout(xaxis_rangeslider_visible=False))
-        fig.add_trace(fig_temp, row=row_count, col=1)
-        row_count += 1
 
+    # Add plots to figure in one call, one row per (symbol, interval)
+    fig.add_traces(traces, rows=list(range(1, len(traces) + 1)), cols=[1] * len(traces))
+
+    # Candlesticks have no WebGL equivalent, keep the zoom and pan state when the figure is updated
+    fig.update_layout(uirevision='constant')
     return fig
 
 